@@ -8,8 +8,15 @@
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
+import json
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
+
+import updateHostsFile
 
 
 def print_failure(msg):
@@ -25,7 +32,7 @@ def print_failure(msg):
     print("\033[91m" + msg + "\033[0m")
 
 
-def update_hosts_file(*flags):
+def update_hosts_file(*flags, **buildparams):
     """
     Wrapper around running updateHostsFile.py
 
@@ -38,10 +45,31 @@ def update_hosts_file(*flags):
         ```
         python updateHostsFile.py -h
         ```
+    buildparams : kwargs
+        If given, the hosts file is built in this process instead of a new
+        one, sharing what can be shared with the other builds. Currently,
+        those fields are:
+
+        1) sourcecache: the host files parsed so far.
+        2) variantmatrix: the variants to deduplicate at once.
+
+    Returns
+    -------
+    readme_updates : dict
+        When built in this process, the information about the hosts file for
+        the README JSON data, or None if the hosts file could not be built.
     """
 
-    if subprocess.call([sys.executable, "updateHostsFile.py"] + list(flags)):
-        print_failure("Failed to update hosts file")
+    if not buildparams:
+        if subprocess.call([sys.executable, "updateHostsFile.py"] + list(flags)):
+            print_failure("Failed to update hosts file")
+        return None
+
+    try:
+        return updateHostsFile.main(list(flags), **buildparams)
+    except (Exception, SystemExit) as e:
+        print_failure("Failed to update hosts file: {}".format(e))
+        return None
 
 
 def update_readme_file():
@@ -53,12 +81,13 @@ def update_readme_file():
         print_failure("Failed to update readme file")
 
 
-def recursively_loop_extensions(extension, extensions, current_extensions):
+def recursively_loop_extensions(extension, extensions, current_extensions, variants):
     """
     Helper function that recursively calls itself to prevent manually creating
     all possible combinations of extensions.
 
-    Will call update_hosts_file for all combinations of extensions
+    Will add the flags of update_hosts_file for all combinations of extensions
+    to variants
     """
 
     c_extensions = extensions.copy()
@@ -68,13 +97,93 @@ def recursively_loop_extensions(extension, extensions, current_extensions):
     name = "-".join(c_current_extensions)
 
     params = ("-a", "-n", "-o", "alternates/"+name, "-e") + tuple(c_current_extensions)
-    update_hosts_file(*params)
+    variants.append(params)
 
     params = ("-a", "-n", "-s", "--nounifiedhosts", "-o", "alternates/"+name+"-only", "-e") + tuple(c_current_extensions)
-    update_hosts_file(*params)
+    variants.append(params)
 
     while len(c_extensions) > 0:
-        recursively_loop_extensions(c_extensions.pop(0), c_extensions, c_current_extensions)
+        recursively_loop_extensions(c_extensions.pop(0), c_extensions, c_current_extensions, variants)
+
+
+# The build parameters of update_hosts_file in a worker process of --jobs.
+workerbuildparams = None
+
+
+def init_build_worker(buildparams):
+    """
+    Initialize a worker process of --jobs.
+
+    Parameters
+    ----------
+    buildparams : dict
+        The build parameters of update_hosts_file.
+    """
+
+    global workerbuildparams
+    workerbuildparams = buildparams
+
+
+def build_variant(flags):
+    """
+    Build a hosts file in a worker process of --jobs.
+
+    The README JSON data is left to the main process, which updates it with
+    the information returned for all the hosts files at once, so that the
+    workers never write it concurrently.
+
+    Parameters
+    ----------
+    flags : tuple
+        Commandline flags to pass into updateHostsFile.py.
+
+    Returns
+    -------
+    readme_updates : dict
+        The information about the hosts file for the README JSON data, or
+        None if the hosts file could not be built.
+    """
+
+    return update_hosts_file(*(flags + ("-g",)), **workerbuildparams)
+
+
+def merge_profiles(profilepaths):
+    """
+    Merge the profiles of the hosts files into one report.
+
+    Parameters
+    ----------
+    profilepaths : dict
+        The path of the profile of each hosts file, by output subfolder.
+        A profile that could not be read, such as the one of a hosts file
+        that failed to build, is left out.
+
+    Returns
+    -------
+    report : dict
+        The profile of each hosts file, by output subfolder, and the time,
+        lines and bytes of each stage, summed over all of them.
+    """
+
+    report = {"wall": 0.0, "cpu": 0.0, "builds": {}, "stages": {}}
+
+    for outputsubfolder, profilepath in profilepaths.items():
+        try:
+            with open(profilepath, "r") as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        report["builds"][outputsubfolder] = profile
+        report["wall"] += profile.get("wall", 0.0)
+        report["cpu"] += profile.get("cpu", 0.0)
+
+        for stage, counts in profile.get("stages", {}).items():
+            total = report["stages"].setdefault(stage, {})
+            for name, value in counts.items():
+                total[name] = total.get(name, 0) + value
+
+    return report
 
 
 def main():
@@ -83,17 +192,129 @@ def main():
         "file from hosts stored in "
         "data subfolders."
     )
-    parser.parse_args()
+    parser.add_argument(
+        "--in-process",
+        dest="inprocess",
+        default=False,
+        action="store_true",
+        help="Build all the hosts files in this process, parsing each "
+        "source only once and removing the duplicates of all of them at once. "
+        "Can't be used with --jobs.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of hosts files to build at a time, in as many worker "
+        "processes. Default is 1. Can't be used with --in-process.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cachedir",
+        default=None,
+        help="Directory in which to keep the parsed host files between runs.",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        dest="skipunchanged",
+        default=False,
+        action="store_true",
+        help="Leave the hosts files whose inputs did not change as they are.",
+    )
+    parser.add_argument(
+        "--write-if-changed",
+        dest="writeifchanged",
+        default=False,
+        action="store_true",
+        help="Leave the hosts files in which only the date would change "
+        "untouched.",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profilefile",
+        default=None,
+        help="File in which to write a JSON report of the time spent in each "
+        "stage of the builds, by hosts file and overall.",
+    )
+    options = parser.parse_args()
 
-    # Update the unified hosts file
-    update_hosts_file("-a")
+    # Every worker would remove the duplicates of all the hosts files again.
+    if options.inprocess and options.jobs > 1:
+        parser.error("--in-process can't be used with --jobs")
 
     # List of extensions we want to generate, we will loop over them recursively to prevent manual definitions
     # Only add new extensions to the end of the array, to avoid relocating existing hosts-files
     extensions = ["fakenews", "gambling", "porn", "social"]
 
+    variants = []
     while len(extensions) > 0:
-        recursively_loop_extensions(extensions.pop(0), extensions, [])
+        recursively_loop_extensions(extensions.pop(0), extensions, [], variants)
+
+    # The worker processes always build the hosts files in-process, sharing
+    # the host files parsed for the unified hosts file.
+    buildparams = {}
+    if options.inprocess or options.jobs > 1:
+        buildparams["sourcecache"] = {}
+    if options.inprocess:
+        buildparams["variantmatrix"] = updateHostsFile.VariantMatrix(
+            [((), False)]
+            + [
+                (flags[flags.index("-e") + 1 :], "--nounifiedhosts" in flags)
+                for flags in variants
+            ]
+        )
+
+    commonflags = ()
+    if options.cachedir:
+        commonflags = ("--cache-dir", options.cachedir)
+    if options.skipunchanged:
+        commonflags += ("--skip-unchanged",)
+    if options.writeifchanged:
+        commonflags += ("--write-if-changed",)
+    builds = [("-a",) + commonflags] + [flags + commonflags for flags in variants]
+
+    # Each hosts file writes its own profile, merged once all are built.
+    profilepaths = {}
+    if options.profilefile:
+        profiledir = tempfile.mkdtemp(prefix="profile-")
+        for i, flags in enumerate(builds):
+            outputsubfolder = flags[flags.index("-o") + 1] if "-o" in flags else ""
+            profilepaths[outputsubfolder] = os.path.join(
+                profiledir, "{}.json".format(i)
+            )
+            builds[i] = flags + ("--profile", profilepaths[outputsubfolder])
+
+    unifiedflags, variants = builds[0], builds[1:]
+
+    # Update the unified hosts file
+    update_hosts_file(*unifiedflags, **buildparams)
+
+    if options.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=options.jobs,
+            initializer=init_build_worker,
+            initargs=(buildparams,),
+        ) as executor:
+            readme_updates_list = [
+                readme_updates
+                for readme_updates in executor.map(build_variant, variants)
+                if readme_updates is not None
+            ]
+
+        updateHostsFile.merge_readme_data(
+            updateHostsFile.get_defaults()["readmedatafilename"], readme_updates_list
+        )
+    else:
+        for flags in variants:
+            update_hosts_file(*flags, **buildparams)
+
+    if options.profilefile:
+        with open(options.profilefile, "w") as f:
+            json.dump(merge_profiles(profilepaths), f, indent=2, sort_keys=True)
+            f.write("\n")
+        shutil.rmtree(profiledir, ignore_errors=True)
 
     # Update the readme files.
     update_readme_file()
@@ -5,6 +5,10 @@
 #
 # Python script for testing updateHostFiles.py
 
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import json
 import locale
 import os
@@ -13,6 +17,8 @@ import re
 import shutil
 import sys
 import tempfile
+import time
+import tracemalloc
 import unittest
 import unittest.mock as mock
 from io import BytesIO, StringIO
@@ -21,37 +27,70 @@ import requests
 
 import updateHostsFile
 from updateHostsFile import (
+    PROFILE_CHUNK_SIZE,
+    RESERVED_HOSTNAMES,
+    BatchWriter,
     Colors,
+    CompactHostnameSet,
+    MemoryTracker,
+    Profile,
+    RejectedRules,
+    VariantMatrix,
+    build_key,
+    build_time,
     colorize,
+    compile_exclusions,
+    compile_filters,
+    compile_whitelist,
+    compress_lines,
+    covered_subdomains,
     display_exclusion_options,
     domain_to_idna,
     exclude_domain,
+    file_digest,
     flush_dns_cache,
     gather_custom_exclusions,
     get_defaults,
     get_file_by_url,
+    get_source_by_url,
+    hosts_file_digest,
+    init_parse_worker,
     is_valid_user_provided_domain_format,
+    main,
     matches_exclusions,
+    matches_whitelist,
+    match_filters,
+    merge_parsed_lines,
+    minimise_lines,
     move_hosts_file_into_place,
     normalize_rule,
+    parse_lines,
+    parse_lines_in_parallel,
     path_join_robust,
     print_failure,
     print_success,
+    prune_parsed_lines,
     prompt_for_exclusions,
     prompt_for_flush_dns_cache,
     prompt_for_move,
     prompt_for_update,
     query_yes_no,
+    read_build_record,
+    read_source_validators,
     recursive_glob,
-    remove_old_hosts_file,
+    remove_dups_and_excl,
+    replace_hosts_file,
     sort_sources,
     strip_rule,
     supports_color,
     update_all_sources,
     update_readme_data,
+    update_source,
     update_sources_data,
+    write_build_record,
     write_data,
     write_opening_header,
+    write_source_validators,
 )
 
 unicode = str
@@ -664,6 +703,114 @@ class TestMatchesExclusions(Base):
             self.assertFalse(matches_exclusions(domain, exclusion_regexes))
 
 
+class TestCompileExclusions(Base):
+    exclusion_pattern = r"([a-zA-Z\d-]+\.){0,}"
+
+    def compile_exclusions(self, domains):
+        exclusion_regexes = []
+        for domain in domains:
+            exclusion_regexes = exclude_domain(
+                domain, self.exclusion_pattern, exclusion_regexes
+            )
+
+        return compile_exclusions(exclusion_regexes, self.exclusion_pattern)
+
+    def test_plain_domains(self):
+        exclusions = self.compile_exclusions(["hulu.com", "Adaway.org"])
+        self.assertEqual(exclusions, ({"hulu.com", "adaway.org"}, []))
+
+        for rule in [
+            "0.0.0.0 hulu.com",
+            "0.0.0.0 ads.hulu.com",
+            "0.0.0.0 a.b.HULU.com",
+            "adaway.org",
+        ]:
+            self.assertTrue(matches_exclusions(rule, exclusions))
+
+        for rule in [
+            "0.0.0.0 nothulu.com",
+            "0.0.0.0 hulu.com.evil.net",
+            "0.0.0.0 huluxcom",
+            "adaway.org.uk",
+        ]:
+            self.assertFalse(matches_exclusions(rule, exclusions))
+
+    def test_regexes(self):
+        exclusions = self.compile_exclusions(["hulu.com", r"ads?\d+\.", "tracker"])
+        self.assertEqual(exclusions[0], {"hulu.com", "tracker"})
+        self.assertEqual(len(exclusions[1]), 1)
+
+        for rule in [
+            "0.0.0.0 ad1.example.org",
+            "0.0.0.0 ads22.example.org",
+            "0.0.0.0 www.hulu.com",
+            "0.0.0.0 tracker",
+        ]:
+            self.assertTrue(matches_exclusions(rule, exclusions))
+
+        for rule in ["0.0.0.0 ads.example.org", "0.0.0.0 mytracker.net"]:
+            self.assertFalse(matches_exclusions(rule, exclusions))
+
+    def test_uncombinable_regexes(self):
+        exclusion_regexes = [
+            re.compile(r"(a)\1"),
+            re.compile(r"example", re.IGNORECASE),
+            re.compile(r"foo\.bar"),
+        ]
+        exclusions = compile_exclusions(exclusion_regexes, self.exclusion_pattern)
+        self.assertEqual(exclusions[0], set())
+        self.assertCountEqual(exclusions[1], exclusion_regexes)
+
+        for rule in ["0.0.0.0 aa.com", "0.0.0.0 EXAMPLE.com", "0.0.0.0 foo.bar"]:
+            self.assertTrue(matches_exclusions(rule, exclusions))
+
+
+class TestMatchesWhitelist(Base):
+    exclusions = [
+        "example.com",
+        ".dotted.org",
+        "0.0.0.0 exact.net",
+        "com.au",
+    ]
+
+    lines = [
+        "0.0.0.0 example.com\n",
+        "0.0.0.0 ads.example.com\n",
+        "0.0.0.0 badexample.com\n",
+        "0.0.0.0 example.com.evil.net\n",
+        "0.0.0.0 example.com",
+        "example.com # hello\n",
+        "0.0.0.0 foo.net # see example.com\n",
+        "0.0.0.0 Example.com\n",
+        "0.0.0.0 .dotted.org\n",
+        "0.0.0.0 a.dotted.org\n",
+        "0.0.0.0 a..dotted.org\n",
+        "0.0.0.0 exact.net\n",
+        "0.0.0.0  exact.net\n",
+        "127.0.0.1 exact.net\n",
+        "0.0.0.0 shop.com.au\n",
+        "0.0.0.0\tshop.com.au\n",
+        "# comment\n",
+        "\n",
+    ]
+
+    def test_empty_whitelist(self):
+        whitelist = compile_whitelist([])
+
+        for line in self.lines:
+            self.assertFalse(matches_whitelist(line, whitelist))
+
+    def test_same_as_regex(self):
+        whitelist = compile_whitelist(self.exclusions)
+
+        for line in self.lines:
+            expected = any(
+                re.search(r"(^|[\s\.])" + re.escape(exclude) + r"\s", line)
+                for exclude in self.exclusions
+            )
+            self.assertEqual(matches_whitelist(line, whitelist), expected, line)
+
+
 # End Exclusion Logic
 
 
@@ -774,7 +921,7 @@ class TestUpdateAllSources(BaseStdout):
     @mock.patch("json.load", return_value={"url": "example.com"})
     @mock.patch("updateHostsFile.recursive_glob", return_value=["foo"])
     @mock.patch("updateHostsFile.write_data", return_value=0)
-    @mock.patch("updateHostsFile.get_file_by_url", return_value="file_data")
+    @mock.patch("updateHostsFile.get_source_by_url", return_value=("file_data", {}))
     def test_one_source(self, mock_get, mock_write, *_):
         update_all_sources(self.source_data_filename, self.hostfilename)
         self.assert_called_once(mock_write)
@@ -789,7 +936,7 @@ class TestUpdateAllSources(BaseStdout):
     @mock.patch("json.load", return_value={"url": "example.com"})
     @mock.patch("updateHostsFile.recursive_glob", return_value=["foo"])
     @mock.patch("updateHostsFile.write_data", return_value=0)
-    @mock.patch("updateHostsFile.get_file_by_url", return_value=Exception("fail"))
+    @mock.patch("updateHostsFile.get_source_by_url", side_effect=Exception("fail"))
     def test_source_fail(self, mock_get, mock_write, *_):
         update_all_sources(self.source_data_filename, self.hostfilename)
         mock_write.assert_not_called()
@@ -810,13 +957,17 @@ class TestUpdateAllSources(BaseStdout):
     @mock.patch("updateHostsFile.recursive_glob", return_value=["foo", "bar"])
     @mock.patch("updateHostsFile.write_data", return_value=0)
     @mock.patch(
-        "updateHostsFile.get_file_by_url", side_effect=[Exception("fail"), "file_data"]
+        "updateHostsFile.get_source_by_url",
+        side_effect=[Exception("fail"), ("file_data", {})],
     )
     def test_sources_fail_succeed(self, mock_get, mock_write, *_):
         update_all_sources(self.source_data_filename, self.hostfilename)
         self.assert_called_once(mock_write)
 
-        get_calls = [mock.call("example.com"), mock.call("example2.com")]
+        get_calls = [
+            mock.call("example.com", {}, None),
+            mock.call("example2.com", {}, None),
+        ]
         mock_get.assert_has_calls(get_calls)
 
         output = sys.stdout.getvalue()
@@ -828,11 +979,632 @@ class TestUpdateAllSources(BaseStdout):
         for expected in expecteds:
             self.assertIn(expected, output)
 
+    @mock.patch("builtins.open", return_value=mock.Mock())
+    @mock.patch("json.load", return_value={"url": "example.com"})
+    @mock.patch("updateHostsFile.recursive_glob", return_value=["foo", "bar"])
+    @mock.patch("updateHostsFile.write_data", return_value=0)
+    @mock.patch("updateHostsFile.get_source_by_url", return_value=("file_data", {}))
+    def test_concurrent_sources(self, mock_get, mock_write, *_):
+        update_all_sources(self.source_data_filename, self.hostfilename, jobs=2)
+        self.assertEqual(mock_write.call_count, 2)
+        self.assertEqual(mock_get.call_count, 2)
+
+        output = sys.stdout.getvalue()
+        expected = "Updating source  from example.com"
+
+        self.assertEqual(output.count(expected), 2)
+
+    @mock.patch("builtins.open", return_value=mock.Mock())
+    @mock.patch("json.load", return_value={"url": "example.com"})
+    @mock.patch("updateHostsFile.recursive_glob", return_value=["foo"])
+    @mock.patch("updateHostsFile.write_data", return_value=0)
+    @mock.patch("updateHostsFile.get_source_by_url", return_value=(None, {}))
+    def test_unchanged_source(self, mock_get, mock_write, *_):
+        update_all_sources(self.source_data_filename, self.hostfilename)
+        mock_write.assert_not_called()
+        self.assert_called_once(mock_get)
+
+        output = sys.stdout.getvalue()
+        expected = "Source  is unchanged"
+
+        self.assertIn(expected, output)
+
+
+class TestSourceValidators(BaseMockDir):
+    def setUp(self):
+        super(TestSourceValidators, self).setUp()
+        self.cachefile = os.path.join(self.test_dir, "update.cache.json")
+
+    def test_missing(self):
+        self.assertDictEqual(read_source_validators(self.cachefile), {})
+
+    def test_damaged(self):
+        with open(self.cachefile, "w") as f:
+            f.write("{not json")
+
+        self.assertDictEqual(read_source_validators(self.cachefile), {})
+
+    def test_round_trip(self):
+        validators = {"etag": '"abc"', "lastmodified": None, "sha256": "0123"}
+        write_source_validators(self.cachefile, validators)
+
+        self.assertDictEqual(read_source_validators(self.cachefile), validators)
+
+    def test_error_status_kept(self):
+        sourcepath = os.path.join(self.test_dir, "adaway")
+        os.makedirs(sourcepath)
+        with open(os.path.join(sourcepath, "update.json"), "w") as f:
+            json.dump({"url": "example.com"}, f)
+        with open(os.path.join(sourcepath, "hosts"), "w") as f:
+            f.write("0.0.0.0 a.com\n")
+        validators = {"etag": '"abc"', "lastmodified": None, "sha256": "0123"}
+        write_source_validators(os.path.join(sourcepath, "update.cache.json"), validators)
+
+        resp_obj = requests.Response()
+        resp_obj.__setstate__({"_content": b"Not Found", "status_code": 404})
+
+        with mock.patch("requests.get", return_value=resp_obj):
+            with mock.patch("sys.stdout", new_callable=StringIO) as stdout:
+                update_source(os.path.join(sourcepath, "update.json"), "hosts")
+
+        self.assertIn("Error in updating source:  example.com", stdout.getvalue())
+        with open(os.path.join(sourcepath, "hosts")) as f:
+            self.assertEqual(f.read(), "0.0.0.0 a.com\n")
+        self.assertDictEqual(
+            read_source_validators(os.path.join(sourcepath, "update.cache.json")),
+            validators,
+        )
+
 
 # End Update Logic
 
 
 # File Logic
+class TestMergeParsedLines(BaseMockDir):
+    def setUp(self):
+        super(TestMergeParsedLines, self).setUp()
+
+        self.datapath = os.path.join(self.test_dir, "data")
+        self.extensionspath = os.path.join(self.test_dir, "extensions")
+
+        self.settings = get_defaults()
+        self.settings.update(
+            datapath=self.datapath,
+            extensionspath=self.extensionspath,
+            extensions=["foo"],
+            blacklistfile=os.path.join(self.test_dir, "blacklist"),
+            workers=1,
+        )
+
+        for hostsfile, contents in (
+            (os.path.join(self.datapath, "adaway", "hosts"), "0.0.0.0 a.com"),
+            (os.path.join(self.extensionspath, "foo", "hosts"), "0.0.0.0 b.com"),
+        ):
+            os.makedirs(os.path.dirname(hostsfile))
+            with open(hostsfile, "w") as f:
+                f.write(contents)
+
+        with open(self.settings["blacklistfile"], "w") as f:
+            f.write("0.0.0.0 c.com\n")
+
+    def merge_parsed_lines(self, nounifiedhosts):
+        with mock.patch("updateHostsFile.settings", self.settings, create=True):
+            return list(merge_parsed_lines(nounifiedhosts=nounifiedhosts))
+
+    # The files are merged as if they were concatenated, so a file that
+    # doesn't end with a newline runs into the next one.
+    def test_unified_hosts(self):
+        lines = [
+            "# Start adaway\n",
+            "\n",
+            "0.0.0.0 a.com\n",
+            "# End adaway\n",
+            "\n",
+            "0.0.0.0 b.com0.0.0.0 c.com\n",
+        ]
+        expected = list(parse_lines(lines, "0.0.0.0", True))
+        self.assertListEqual(self.merge_parsed_lines(False), expected)
+
+    def test_no_unified_hosts(self):
+        expected = list(parse_lines(["0.0.0.0 b.com0.0.0.0 c.com\n"], "0.0.0.0", True))
+        self.assertListEqual(self.merge_parsed_lines(True), expected)
+
+    def test_stripped_last_line(self):
+        # The last line of each file is parsed on its own before being joined
+        # with the next file, even when it is stripped down to nothing.
+        with open(os.path.join(self.datapath, "adaway", "hosts"), "w") as f:
+            f.write("0.0.0.0 a.com\n ")
+        with open(os.path.join(self.extensionspath, "foo", "hosts"), "w") as f:
+            f.write("0.0.0.0 b.com\n..")
+
+        parsedlines = self.merge_parsed_lines(False)
+
+        self.assertIn(("0.0.0.0 a.com\n", "0.0.0.0 a.com", "a.com", "0.0.0.0 a.com\n"), parsedlines)
+        self.assertIn((" \n", None, None, " \n"), parsedlines)
+        self.assertEqual(parsedlines[-1][0], "..0.0.0.0 c.com\n")
+
+    def test_source_cache(self):
+        self.settings.update(sourcecache={})
+        self.merge_parsed_lines(False)
+
+        self.assertEqual(len(self.settings["sourcecache"]), 3)
+
+        with mock.patch("updateHostsFile.parse_lines") as parse_lines_mock:
+            parse_lines_mock.side_effect = lambda lines, *args: list(
+                parse_lines(lines, *args)
+            )
+            self.merge_parsed_lines(False)
+
+        # Only the start and end markers of the base source are parsed again.
+        self.assertEqual(parse_lines_mock.call_count, 2)
+
+    def test_rejects(self):
+        rejects = RejectedRules(keeprules=True)
+        self.settings.update(rejects=rejects)
+
+        adaway = os.path.join(self.datapath, "adaway", "hosts")
+        with open(adaway, "w") as f:
+            f.write("0.0.0.0 1.2.3.4\n0.0.0.0 a.com\n0.0.0.0 bad/rule # c\n")
+        with open(self.settings["blacklistfile"], "w") as f:
+            f.write("0.0.0.0 c.com\n0.0.0.0 -c.com\n")
+
+        self.merge_parsed_lines(False)
+
+        adaway = os.path.relpath(adaway, updateHostsFile.BASEDIR_PATH)
+        blacklist = os.path.relpath(
+            self.settings["blacklistfile"], updateHostsFile.BASEDIR_PATH
+        )
+
+        self.assertDictEqual(rejects.counts, {adaway: 2, blacklist: 1})
+        self.assertEqual(
+            rejects.summary(),
+            "Skipped 3 invalid rules:\n  {}: 2\n  {}: 1\n".format(adaway, blacklist),
+        )
+
+        rejectsfile = StringIO()
+        rejects.write(rejectsfile)
+        self.assertEqual(
+            rejectsfile.getvalue(),
+            "{0}\t0.0.0.0 1.2.3.4\n"
+            "{0}\t0.0.0.0 bad/rule # c\n"
+            "{1}\t0.0.0.0 -c.com\n".format(adaway, blacklist),
+        )
+
+    def test_cache_dir(self):
+        cachedir = os.path.join(self.test_dir, "cache")
+        self.settings.update(cachedir=cachedir)
+
+        with open(os.path.join(self.datapath, "adaway", "hosts"), "w") as f:
+            f.write("# comment\n0.0.0.0 a.com # a\n::1 a.com\n0.0.0.0 a.com.\n")
+
+        expected = self.merge_parsed_lines(False)
+        self.assertEqual(len(os.listdir(cachedir)), 3)
+
+        with mock.patch("updateHostsFile.parse_lines") as parse_lines_mock:
+            parse_lines_mock.side_effect = lambda lines, *args: list(
+                parse_lines(lines, *args)
+            )
+            self.assertListEqual(self.merge_parsed_lines(False), expected)
+
+        # Only the start and end markers of the base source are parsed again.
+        self.assertEqual(parse_lines_mock.call_count, 2)
+
+        with open(os.path.join(self.datapath, "adaway", "hosts"), "w") as f:
+            f.write("0.0.0.0 d.com\n")
+
+        self.settings.update(targetip="127.0.0.1")
+
+        with mock.patch("updateHostsFile.parse_lines") as parse_lines_mock:
+            parse_lines_mock.side_effect = lambda lines, *args: list(
+                parse_lines(lines, *args)
+            )
+            self.assertIn(
+                ("0.0.0.0 d.com\n", "0.0.0.0 d.com", "d.com", "127.0.0.1 d.com\n"),
+                self.merge_parsed_lines(False),
+            )
+
+        # The changed source and the changed target IP parse everything again.
+        self.assertEqual(parse_lines_mock.call_count, 5)
+
+
+class TestMatchFilters(Base):
+    filters = ["he", "she", "his", "hers", "olx.pl", "c752sa3k9"]
+
+    def test_no_filters(self):
+        automaton = compile_filters([])
+        self.assertIsNone(match_filters("0.0.0.0 she.example.com\n", automaton))
+
+    def test_empty_filter(self):
+        automaton = compile_filters(["", "foo"])
+        self.assertEqual(match_filters("0.0.0.0 bar.com\n", automaton), 0)
+
+    def test_match(self):
+        automaton = compile_filters(self.filters)
+
+        for line, expected in (
+            ("0.0.0.0 ushers.com\n", 1),
+            ("0.0.0.0 this.net\n", 2),
+            ("0.0.0.0 ahishe.net\n", 2),
+            ("0.0.0.0 m.olx.pl\n", 4),
+            ("0.0.0.0 c752sa3k9.top # hers\n", 5),
+            ("0.0.0.0 hxrs.olx.p\n", None),
+            ("# comment\n", None),
+        ):
+            self.assertEqual(match_filters(line, automaton), expected, line)
+
+    def test_same_as_substrings(self):
+        automaton = compile_filters(self.filters)
+
+        for line in (
+            "0.0.0.0 " + "".join(chars) + ".com\n"
+            for chars in itertools.product("hers.x", repeat=4)
+        ):
+            expected = any(f in line for f in self.filters)
+            matched = match_filters(line, automaton)
+
+            self.assertEqual(matched is not None, expected, line)
+            if expected:
+                self.assertIn(self.filters[matched], line)
+
+
+class TestCoveredSubdomains(Base):
+    def test_no_hostnames(self):
+        self.assertSetEqual(covered_subdomains([]), set())
+
+    def test_covered(self):
+        hostnames = [
+            "a.b.example.com",
+            "example.com",
+            "b.example.com",
+            "badexample.com",
+            "example.com.evil.net",
+            "ads.example.org",
+            "x.ads.example.org",
+            "tracker.example.org",
+        ]
+        expected = {"a.b.example.com", "b.example.com", "x.ads.example.org"}
+
+        self.assertSetEqual(covered_subdomains(iter(hostnames)), expected)
+
+
+class TestVariantMatrix(BaseMockDir):
+    variants = [
+        ((), False),
+        (("bar",), False),
+        (("bar",), True),
+        (("bar", "foo"), False),
+        (("bar", "foo"), True),
+    ]
+
+    def setUp(self):
+        super(TestVariantMatrix, self).setUp()
+
+        self.settings = get_defaults()
+        self.settings.update(
+            datapath=os.path.join(self.test_dir, "data"),
+            extensionspath=os.path.join(self.test_dir, "extensions"),
+            blacklistfile=os.path.join(self.test_dir, "blacklist"),
+            workers=1,
+        )
+
+        self.pruneparams = {
+            "filterautomaton": compile_filters(["olx.pl"]),
+            "exclusions": compile_exclusions([]),
+            "whitelist": compile_whitelist([]),
+        }
+
+        for hostsfile, contents in (
+            ("data/adaway/hosts", "0.0.0.0 a.com\n0.0.0.0 b.com\n"),
+            ("extensions/foo/hosts", "0.0.0.0 b.com\n0.0.0.0 c.com\n0.0.0.0 olx.pl\n"),
+            ("extensions/bar/hosts", "# bar\n0.0.0.0 c.com\n0.0.0.0 d.com\n"),
+            ("blacklist", "0.0.0.0 d.com\n0.0.0.0 e.com"),
+        ):
+            hostsfile = os.path.join(self.test_dir, hostsfile)
+            os.makedirs(os.path.dirname(hostsfile), exist_ok=True)
+            with open(hostsfile, "w") as f:
+                f.write(contents)
+
+    def variant_lines(self, matrix, extensions, nounifiedhosts):
+        self.settings.update(extensions=list(extensions), nounifiedhosts=nounifiedhosts)
+
+        with mock.patch("updateHostsFile.settings", self.settings, create=True):
+            filtercounts = [0]
+            lines = matrix.variant_lines(self.pruneparams, "key", filtercounts)
+            if lines is not None:
+                lines = list(lines)
+
+        return lines, filtercounts
+
+    def expected_lines(self, extensions, nounifiedhosts):
+        self.settings.update(extensions=list(extensions), nounifiedhosts=nounifiedhosts)
+
+        with mock.patch("updateHostsFile.settings", self.settings, create=True):
+            filtercounts = [0]
+            parsedlines = merge_parsed_lines(nounifiedhosts=nounifiedhosts)
+            prunedlines = prune_parsed_lines(
+                parsedlines, self.pruneparams, filtercounts
+            )
+
+            lines = []
+            hostnames = set(RESERVED_HOSTNAMES)
+            for hostname, data in prunedlines:
+                if hostname not in hostnames:
+                    lines.append((hostname, data))
+                    if hostname is not None:
+                        hostnames.add(hostname)
+
+        return lines, filtercounts
+
+    def test_variants(self):
+        matrix = VariantMatrix(self.variants)
+
+        for extensions, nounifiedhosts in self.variants:
+            self.assertEqual(
+                self.variant_lines(matrix, extensions, nounifiedhosts),
+                self.expected_lines(extensions, nounifiedhosts),
+            )
+
+    def test_unknown_variant(self):
+        matrix = VariantMatrix(self.variants)
+        self.assertEqual(self.variant_lines(matrix, ("foo",), False), (None, [0]))
+
+    def test_unterminated_group(self):
+        with open(os.path.join(self.test_dir, "extensions/bar/hosts"), "a") as f:
+            f.write("0.0.0.0 f.com")
+
+        matrix = VariantMatrix(self.variants)
+        self.assertEqual(self.variant_lines(matrix, ("bar",), False), (None, [0]))
+
+    def test_rejects(self):
+        for hostsfile in ("data/adaway/hosts", "extensions/foo/hosts", "blacklist"):
+            with open(os.path.join(self.test_dir, hostsfile), "a") as f:
+                f.write("\n0.0.0.0 bad/{}\n".format(hostsfile))
+
+        for keeprules in (True, False):
+            matrix = VariantMatrix(self.variants)
+
+            # Each variant only gets the invalid rules of its own groups,
+            # however many variants share the pass.
+            for extensions, nounifiedhosts in self.variants:
+                rejects = []
+                for variant_lines in (
+                    functools.partial(self.variant_lines, matrix),
+                    self.expected_lines,
+                ):
+                    self.settings.update(rejects=RejectedRules(keeprules=keeprules))
+                    variant_lines(extensions, nounifiedhosts)
+                    rejects.append(
+                        (self.settings["rejects"].counts, self.settings["rejects"].rules)
+                    )
+
+                self.assertEqual(rejects[0], rejects[1])
+
+            if keeprules:
+                self.assertEqual(len(rejects[0][1]), 2)
+            else:
+                # Without a rejects file, the matrix doesn't keep the rules
+                # either.
+                for deduplicated in matrix.passes.values():
+                    for grouprejects in deduplicated[3]:
+                        self.assertIsNone(grouprejects.rules)
+
+
+class TestCompactHostnameSet(Base):
+    def test_basic(self):
+        hostnames = CompactHostnameSet(["localhost", "local"])
+        self.assertEqual(len(hostnames), 2)
+
+        for hostname in ["example.com", "www.example.com", "example.com"]:
+            hostnames.add(hostname)
+
+        self.assertEqual(len(hostnames), 4)
+        for hostname in ["localhost", "local", "example.com", "www.example.com"]:
+            self.assertIn(hostname, hostnames)
+        for hostname in ["", "locals", "example.co", "xn--hualae-0wa.cl"]:
+            self.assertNotIn(hostname, hostnames)
+
+    def test_resize(self):
+        expected = ["host{}.example.org".format(i) for i in range(1000)]
+        hostnames = CompactHostnameSet(expected + expected)
+
+        self.assertEqual(len(hostnames), 1000)
+        self.assertGreaterEqual(len(hostnames.slots), 2000)
+        for hostname in expected:
+            self.assertIn(hostname, hostnames)
+        self.assertNotIn("host1000.example.org", hostnames)
+
+    def test_hash_collisions(self):
+        with mock.patch.object(CompactHostnameSet, "hash", return_value=42):
+            hostnames = CompactHostnameSet(["a.com", "b.com", "a.com"])
+
+            self.assertEqual(len(hostnames), 2)
+            self.assertIn("a.com", hostnames)
+            self.assertIn("b.com", hostnames)
+            self.assertNotIn("c.com", hostnames)
+
+
+class TestCompressLines(Base):
+    lines = [
+        "# Start adaway\n",
+        "\n",
+        "0.0.0.0 a.com\n",
+        "0.0.0.0 b.com # comment\n",
+        "0.0.0.0 c.com\n",
+        "# End adaway\n",
+        "0.0.0.0 d.com\n",
+        "0.0.0.0 e.com\n",
+    ]
+
+    def test_compress(self):
+        expected = ["\n", "0.0.0.0 a.com b.com c.com d.com e.com"]
+        actual = list(compress_lines(self.lines, "0.0.0.0"))
+
+        self.assertListEqual(actual, expected)
+
+    def test_domains_per_line(self):
+        expected = [
+            "\n",
+            "0.0.0.0 a.com b.com\n",
+            "0.0.0.0 c.com d.com\n",
+            "0.0.0.0 e.com",
+        ]
+        actual = list(compress_lines(self.lines, "0.0.0.0", domainsperline=2))
+
+        self.assertListEqual(actual, expected)
+
+    def test_no_rules(self):
+        expected = ["\n", "127.0.0.1"]
+        actual = list(compress_lines(self.lines, "127.0.0.1"))
+
+        self.assertListEqual(actual, expected)
+
+
+class TestMinimiseLines(Base):
+    def test_minimise(self):
+        lines = [
+            "# Start adaway\n",
+            "\n",
+            "0.0.0.0 a.com\n",
+            "0.0.0.0 b.com # comment\n",
+            "# End adaway\n",
+        ]
+
+        expected = ["\n", "0.0.0.0 a.com\n", "0.0.0.0 b.com\n"]
+        actual = list(minimise_lines(lines, "0.0.0.0"))
+
+        self.assertListEqual(actual, expected)
+
+
+class TestPruneLines(BaseStdout):
+    lines = [
+        "# Start adaway\n",
+        "\n",
+        "0.0.0.0 example.com\n",
+        "127.0.0.1\tWWW.Example.com   # comment\n",
+        "0.0.0.0 ads.olx.pl\n",
+        "::1 localhost\n",
+        "0.0.0.0 user@example.com\n",
+        "0.0.0.0 hulu.com\n",
+        "0.0.0.0 whitelisted.net\n",
+        "0.0.0.0 example.com\n",
+        "0.0.0.0 128.0.0.2\n",
+        "example.org\n",
+    ]
+
+    expected = [
+        (None, "# Start adaway\n"),
+        (None, "\n"),
+        ("example.com", "0.0.0.0 example.com\n"),
+        ("www.example.com", "0.0.0.0 www.example.com # comment\n"),
+        ("example.com", "0.0.0.0 example.com\n"),
+        ("example.org", "0.0.0.0 example.org\n"),
+    ]
+
+    def setUp(self):
+        super(TestPruneLines, self).setUp()
+        self.pruneparams = {
+            "filterautomaton": compile_filters(["olx.pl"]),
+            "exclusions": compile_exclusions([re.compile("hulu")]),
+            "whitelist": compile_whitelist(["whitelisted.net"]),
+        }
+
+    def test_parse_lines_in_parallel(self):
+        expected = list(parse_lines(self.lines, "0.0.0.0", True))
+
+        with mock.patch("updateHostsFile.PARSE_CHUNK_SIZE", 3):
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=2,
+                initializer=init_parse_worker,
+                initargs=("0.0.0.0", True),
+            ) as executor:
+                actual = list(parse_lines_in_parallel(self.lines, executor, 2))
+
+        self.assertListEqual(actual, expected)
+
+    def test_parse_memo_in_parallel(self):
+        lines = self.lines * 2
+        stats = {"hits": 0, "misses": 0}
+
+        with mock.patch("updateHostsFile.PARSE_CHUNK_SIZE", len(self.lines)):
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1,
+                initializer=init_parse_worker,
+                initargs=("0.0.0.0", True, 100),
+            ) as executor:
+                with mock.patch("updateHostsFile.parsememostats", stats):
+                    list(parse_lines_in_parallel(lines, executor, 1))
+
+        # The counts of the worker process are added up in this process.
+        misses = len(set(lines))
+        self.assertEqual(stats, {"hits": len(lines) - misses, "misses": misses})
+
+    def test_parse_memo(self):
+        lines = self.lines * 2
+        expected = list(parse_lines(lines, "0.0.0.0", True))
+
+        for memosize in (100, 4):
+            stats = {"hits": 0, "misses": 0}
+            with mock.patch("updateHostsFile.parsememo", {}), mock.patch(
+                "updateHostsFile.parsememostats", stats
+            ):
+                actual = list(parse_lines(lines, "0.0.0.0", True, memosize))
+
+            self.assertListEqual(actual, expected)
+            self.assertEqual(stats["hits"] + stats["misses"], len(lines))
+
+            if memosize == 100:
+                self.assertEqual(stats["misses"], len(set(lines)))
+
+    def test_prune_parsed_lines(self):
+        filtercounts = [0]
+        parsedlines = parse_lines(self.lines, "0.0.0.0", True)
+        actual = list(prune_parsed_lines(parsedlines, self.pruneparams, filtercounts))
+
+        self.assertListEqual(actual, self.expected)
+        self.assertListEqual(filtercounts, [1])
+
+
+class TestRemoveDupsAndExcl(BaseMockDir):
+    lines = ["0.0.0.0 a.com\n", "0.0.0.0 ads.olx.pl\n", "0.0.0.0 a.com\n"]
+
+    def remove_dups_and_excl(self, **options):
+        settings = get_defaults()
+        settings.update(
+            outputpath=self.test_dir,
+            whitelistfile=os.path.join(self.test_dir, "whitelist"),
+            dedup="set",
+            collapsesubdomains=False,
+            domainsperline=9,
+            **options
+        )
+
+        with open(os.path.join(self.test_dir, "post.json"), "w") as f:
+            json.dump({"filters": ["olx.pl"]}, f)
+
+        parsedlines = parse_lines(self.lines, "0.0.0.0", True)
+        with open(os.path.join(self.test_dir, "hosts"), "w+b") as finalfile:
+            with mock.patch("updateHostsFile.settings", settings, create=True):
+                remove_dups_and_excl(parsedlines, [], finalfile)
+
+            finalfile.seek(0)
+            return finalfile.read().decode("UTF-8"), settings["numberofrules"]
+
+    def test_post_json(self):
+        with mock.patch("sys.stdout", new_callable=StringIO):
+            self.assertEqual(self.remove_dups_and_excl(), ("0.0.0.0 a.com\n", 1))
+
+    def test_reduced_without_post_json(self):
+        # Compressed and minimised hosts files were never filtered by post.json.
+        self.assertEqual(
+            self.remove_dups_and_excl(compress=True),
+            ("\n0.0.0.0 a.com ads.olx.pl", 2),
+        )
+        self.assertEqual(
+            self.remove_dups_and_excl(minimise=True),
+            ("\n0.0.0.0 a.com\n0.0.0.0 ads.olx.pl\n", 2),
+        )
+
+
 class TestNormalizeRule(BaseStdout):
     def test_no_match(self):
         kwargs = dict(targetip="0.0.0.0", keep_domain_comments=False)
@@ -855,11 +1627,8 @@ class TestNormalizeRule(BaseStdout):
         ]:
             self.assertEqual(normalize_rule(rule, **kwargs), (None, None))
 
-            output = sys.stdout.getvalue()
-            sys.stdout = StringIO()
-
-            expected = "==>" + rule + "<=="
-            self.assertIn(expected, output)
+        # Invalid rules are reported by the caller, not printed one by one.
+        self.assertEqual(sys.stdout.getvalue(), "")
 
     def test_mixed_cases(self):
         for rule, expected_target in (
@@ -925,12 +1694,22 @@ class TestNormalizeRule(BaseStdout):
             )
             self.assertEqual(actual, (None, None))
 
-            output = sys.stdout.getvalue()
+    def test_ip_shapes(self):
+        kwargs = dict(targetip="0.0.0.0", keep_domain_comments=False)
 
-            expected = "==>" + rule + "<=="
-            self.assertIn(expected, output)
+        for rule in (
+            "::ffff:127.0.0.1 example.com",
+            "fe80::1%lo0 example.com",
+            "10.0.0.1\texample.com",
+        ):
+            self.assertEqual(
+                normalize_rule(rule, **kwargs),
+                ("example.com", "0.0.0.0 example.com\n"),
+            )
 
-            sys.stdout = StringIO()
+        # Shaped like an IP address, yet neither an IP address nor a domain.
+        for rule in ("999.0.0.1 example.com", "1.2.3.4"):
+            self.assertEqual(normalize_rule(rule, **kwargs), (None, None))
 
     def test_no_comment_raw(self):
         for rule in (
@@ -1069,6 +1848,45 @@ class TestWriteOpeningHeader(BaseMockDir):
         ):
             self.assertNotIn(expected, contents)
 
+    def test_header_only(self):
+        kwargs = dict(
+            extensions="", outputsubfolder="", numberofrules=5, skipstatichosts=True, nounifiedhosts=False
+        )
+        self.final_file.write(b"# Preceding line\n")
+        write_opening_header(self.final_file, **kwargs)
+
+        contents = self.final_file.getvalue()
+        contents = contents.decode("UTF-8")
+
+        self.assertTrue(contents.startswith("# Preceding line\n# Title: "))
+        self.assertEqual(contents.count("# Preceding line"), 1)
+
+    def test_source_date_epoch(self):
+        kwargs = dict(
+            extensions="", outputsubfolder="", numberofrules=5, skipstatichosts=True, nounifiedhosts=False
+        )
+        with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": "1700000000"}):
+            write_opening_header(self.final_file, **kwargs)
+
+        contents = self.final_file.getvalue()
+        contents = contents.decode("UTF-8")
+
+        self.assertIn("# Date: 14 November 2023 22:13:20 (", contents)
+
+    def test_invalid_source_date_epoch(self):
+        for sourcedateepoch in ("yesterday", "1e9", str(10 ** 30)):
+            with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": sourcedateepoch}):
+                with mock.patch("time.gmtime", wraps=time.gmtime) as gmtime:
+                    with mock.patch("sys.stdout", new_callable=StringIO) as stdout:
+                        actual = build_time()
+
+            self.assertIsInstance(actual, time.struct_time)
+            gmtime.assert_called_with()
+            self.assertIn(
+                "Invalid SOURCE_DATE_EPOCH {!r}".format(sourcedateepoch),
+                stdout.getvalue(),
+            )
+
     def test_basic_include_static_hosts(self):
         kwargs = dict(
             extensions="", outputsubfolder="", numberofrules=5, skipstatichosts=False, nounifiedhosts=False
@@ -1416,6 +2234,17 @@ class TestMoveHostsFile(BaseStdout):
             output = sys.stdout.getvalue()
             self.assertIn(expected, output)
 
+    @mock.patch("os.path.abspath", side_effect=lambda f: f)
+    def test_move_hosts_path(self, _):
+        with self.mock_property("platform.system") as obj:
+            obj.return_value = "Linux"
+
+            self.assertFalse(move_hosts_file_into_place("foo/hosts"))
+
+            expected = "foo/hosts does not exist."
+            output = sys.stdout.getvalue()
+            self.assertIn(expected, output)
+
 
 class TestFlushDnsCache(BaseStdout):
     @mock.patch("subprocess.call", return_value=0)
@@ -1523,54 +2352,55 @@ class TestFlushDnsCache(BaseStdout):
                     self.assertIn(expected, output)
 
 
-class TestRemoveOldHostsFile(BaseMockDir):
+class TestReplaceHostsFile(BaseMockDir):
     def setUp(self):
-        super(TestRemoveOldHostsFile, self).setUp()
-        self.hostsfile = "hosts"
+        super(TestReplaceHostsFile, self).setUp()
         self.full_hosts_path = os.path.join(self.test_dir, "hosts")
+        self.new_hosts_path = os.path.join(self.test_dir, "hosts.tmp")
+
+        with open(self.new_hosts_path, "w") as f:
+            f.write("bar")
 
-    def test_remove_hosts_file(self):
+    def test_replace_hosts_file(self):
         old_dir_count = self.dir_count
 
-        remove_old_hosts_file(self.test_dir, self.hostsfile, backup=False)
+        replace_hosts_file(self.new_hosts_path, self.full_hosts_path, backup=False)
 
-        new_dir_count = old_dir_count + 1
-        self.assertEqual(self.dir_count, new_dir_count)
+        self.assertEqual(self.dir_count, old_dir_count)
+        self.assertFalse(os.path.exists(self.new_hosts_path))
 
         with open(self.full_hosts_path, "r") as f:
             contents = f.read()
-            self.assertEqual(contents, "")
+            self.assertEqual(contents, "bar")
 
-    def test_remove_hosts_file_exists(self):
+    def test_replace_hosts_file_exists(self):
         with open(self.full_hosts_path, "w") as f:
             f.write("foo")
 
         old_dir_count = self.dir_count
 
-        remove_old_hosts_file(self.test_dir, self.hostsfile, backup=False)
+        replace_hosts_file(self.new_hosts_path, self.full_hosts_path, backup=False)
 
-        new_dir_count = old_dir_count
-        self.assertEqual(self.dir_count, new_dir_count)
+        self.assertEqual(self.dir_count, old_dir_count - 1)
 
         with open(self.full_hosts_path, "r") as f:
             contents = f.read()
-            self.assertEqual(contents, "")
+            self.assertEqual(contents, "bar")
 
     @mock.patch("time.strftime", return_value="new")
-    def test_remove_hosts_file_backup(self, _):
+    def test_replace_hosts_file_backup(self, _):
         with open(self.full_hosts_path, "w") as f:
             f.write("foo")
 
         old_dir_count = self.dir_count
 
-        remove_old_hosts_file(self.test_dir, self.hostsfile, backup=True)
+        replace_hosts_file(self.new_hosts_path, self.full_hosts_path, backup=True)
 
-        new_dir_count = old_dir_count + 1
-        self.assertEqual(self.dir_count, new_dir_count)
+        self.assertEqual(self.dir_count, old_dir_count)
 
         with open(self.full_hosts_path, "r") as f:
             contents = f.read()
-            self.assertEqual(contents, "")
+            self.assertEqual(contents, "bar")
 
         new_hostsfile = self.full_hosts_path + "-new"
 
@@ -1578,6 +2408,148 @@ class TestRemoveOldHostsFile(BaseMockDir):
             contents = f.read()
             self.assertEqual(contents, "foo")
 
+    @unittest.skipIf(os.name == "nt", "File modes are not enforced on Windows")
+    def test_replace_hosts_file_mode(self):
+        os.chmod(self.new_hosts_path, 0o600)
+
+        umask = os.umask(0o022)
+        try:
+            replace_hosts_file(self.new_hosts_path, self.full_hosts_path, backup=False)
+        finally:
+            os.umask(umask)
+
+        self.assertEqual(os.stat(self.full_hosts_path).st_mode & 0o777, 0o644)
+
+
+class TestBuildKey(BaseMockDir):
+    def setUp(self):
+        super(TestBuildKey, self).setUp()
+
+        self.settings = get_defaults()
+        self.settings.update(
+            datapath=os.path.join(self.test_dir, "data"),
+            extensionspath=os.path.join(self.test_dir, "extensions"),
+            blacklistfile=os.path.join(self.test_dir, "blacklist"),
+            whitelistfile=os.path.join(self.test_dir, "whitelist"),
+            outputpath=self.test_dir,
+        )
+
+        os.makedirs(os.path.join(self.settings["datapath"], "adaway"))
+        self.hostsfile = os.path.join(self.settings["datapath"], "adaway", "hosts")
+        with open(self.hostsfile, "w") as f:
+            f.write("0.0.0.0 a.com\n")
+
+    def build_key(self, exclusionregexes=(), sourcesdata=()):
+        with mock.patch("updateHostsFile.settings", self.settings, create=True):
+            return build_key(list(exclusionregexes), list(sourcesdata))
+
+    def test_same_inputs(self):
+        self.assertEqual(self.build_key(), self.build_key())
+
+    def test_changed_inputs(self):
+        key = self.build_key()
+
+        with open(self.hostsfile, "a") as f:
+            f.write("0.0.0.0 b.com\n")
+        self.assertNotEqual(self.build_key(), key)
+        key = self.build_key()
+
+        with open(self.settings["whitelistfile"], "w") as f:
+            f.write("b.com\n")
+        self.assertNotEqual(self.build_key(), key)
+        key = self.build_key()
+
+        with open(os.path.join(self.test_dir, "post.json"), "w") as f:
+            f.write('{"filters": ["b."]}')
+        self.assertNotEqual(self.build_key(), key)
+        key = self.build_key()
+
+        self.assertNotEqual(self.build_key([re.compile("b.com")]), key)
+        self.assertNotEqual(self.build_key(sourcesdata=[{"name": "adaway"}]), key)
+
+        self.settings.update(targetip="127.0.0.1")
+        self.assertNotEqual(self.build_key(), key)
+
+
+class TestHostsFileDigest(Base):
+    def test_date_ignored(self):
+        for old, new in (
+            (b"# Title\n# Date: 1 May\n0.0.0.0 a.com\n", b"# Title\n# Date: 2 May\n"),
+            (b"# Title\n0.0.0.0 a.com\n", b"# Title\n"),
+        ):
+            self.assertEqual(
+                hosts_file_digest(BytesIO(old)),
+                hosts_file_digest(BytesIO(new), BytesIO(b"0.0.0.0 a.com\n")),
+            )
+
+    def test_changed(self):
+        for old, new in (
+            (b"# Date: 1 May\n0.0.0.0 a.com\n", b"# Date: 1 May\n0.0.0.0 b.com\n"),
+            (b"# Date: 1 May\n# Date: 1 May\n", b"# Date: 1 May\n# Date: 2 May\n"),
+        ):
+            self.assertNotEqual(
+                hosts_file_digest(BytesIO(old)), hosts_file_digest(BytesIO(new))
+            )
+
+
+class TestBuildRecord(BaseMockDir):
+    def setUp(self):
+        super(TestBuildRecord, self).setUp()
+        self.cachefile = os.path.join(self.test_dir, "build.cache.json")
+
+    def test_missing(self):
+        self.assertDictEqual(read_build_record(self.cachefile), {})
+        self.assertIsNone(file_digest(self.cachefile))
+
+    def test_damaged(self):
+        with open(self.cachefile, "w") as f:
+            f.write("{not json")
+
+        self.assertDictEqual(read_build_record(self.cachefile), {})
+
+    def test_round_trip(self):
+        record = {"key": "abc", "numberofrules": 3, "sha256": "0123"}
+        write_build_record(self.cachefile, record)
+
+        self.assertDictEqual(read_build_record(self.cachefile), record)
+
+
+class TestMainSkipUnchanged(BaseMockDir):
+    def setUp(self):
+        super(TestMainSkipUnchanged, self).setUp()
+
+        sourcepath = os.path.join(self.test_dir, "data", "adaway")
+        os.makedirs(sourcepath)
+        os.makedirs(os.path.join(self.test_dir, "extensions"))
+        with open(os.path.join(sourcepath, "update.json"), "w") as f:
+            json.dump({"name": "AdAway", "url": "https://adaway.org/hosts.txt"}, f)
+        with open(os.path.join(sourcepath, "hosts"), "w") as f:
+            f.write("0.0.0.0 a.com\n")
+
+    def main(self, *argv):
+        with mock.patch("updateHostsFile.BASEDIR_PATH", self.test_dir):
+            with mock.patch("updateHostsFile.prompt_for_move") as prompt_for_move:
+                prompt_for_move.return_value = False
+                with mock.patch("sys.stdout", new_callable=StringIO) as stdout:
+                    readme_updates = main(["-a", "-n", "-g"] + list(argv))
+
+        return readme_updates, prompt_for_move, stdout.getvalue()
+
+    def test_move_up_to_date(self):
+        self.main("--skip-unchanged")
+        readme_updates, prompt_for_move, output = self.main(
+            "--skip-unchanged", "--replace"
+        )
+
+        self.assertIn("is up to date", output)
+        self.assertEqual(readme_updates["numberofrules"], 1)
+        prompt_for_move.assert_called_once_with(
+            os.path.join(self.test_dir, "hosts"),
+            auto=True,
+            replace=True,
+            skipstatichosts=False,
+        )
+
 
 # End File Logic
 
@@ -1772,6 +2744,62 @@ class GetFileByUrl(BaseStdout):
         )
 
 
+class GetSourceByUrl(Base):
+    @staticmethod
+    def response(status_code, content=b"", headers=None):
+        resp_obj = requests.Response()
+        resp_obj.__setstate__({"_content": content, "status_code": status_code})
+        resp_obj.headers.update(headers or {})
+        return resp_obj
+
+    def test_conditional_headers(self):
+        validators = {"etag": '"abc"', "lastmodified": "yesterday", "sha256": "0"}
+
+        with mock.patch("requests.get", return_value=self.response(304)) as mock_get:
+            actual = get_source_by_url("www.test-url.com", validators)
+
+        self.assertEqual(actual, (None, validators))
+        mock_get.assert_called_once_with(
+            url="www.test-url.com",
+            headers={"If-None-Match": '"abc"', "If-Modified-Since": "yesterday"},
+        )
+
+    def test_changed(self):
+        resp_obj = self.response(200, b"www.huala\xc3\xb1e.cl", {"ETag": '"def"'})
+
+        with mock.patch("requests.get", return_value=resp_obj) as mock_get:
+            actual = get_source_by_url("www.test-url.com", {})
+
+        expected = (
+            "www.xn--hualae-0wa.cl",
+            {
+                "etag": '"def"',
+                "lastmodified": None,
+                "sha256": hashlib.sha256(b"www.huala\xc3\xb1e.cl").hexdigest(),
+            },
+        )
+        self.assertEqual(actual, expected)
+        mock_get.assert_called_once_with(url="www.test-url.com", headers={})
+
+    def test_same_content(self):
+        sha256 = hashlib.sha256(b"hello, world").hexdigest()
+        resp_obj = self.response(200, b"hello, world")
+
+        with mock.patch("requests.get", return_value=resp_obj):
+            actual = get_source_by_url("www.test-url.com", {"sha256": sha256})
+
+        expected = (None, {"etag": None, "lastmodified": None, "sha256": sha256})
+        self.assertEqual(actual, expected)
+
+    def test_error_status(self):
+        validators = {"etag": '"abc"', "lastmodified": None, "sha256": "0"}
+        resp_obj = self.response(404, b"Not Found", {"ETag": '"def"'})
+
+        with mock.patch("requests.get", return_value=resp_obj):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                get_source_by_url("www.test-url.com", validators)
+
+
 class TestWriteData(Base):
     def test_write_basic(self):
         f = BytesIO()
@@ -1796,6 +2824,114 @@ class TestWriteData(Base):
         self.assertEqual(actual, expected)
 
 
+class TestBatchWriter(Base):
+    def test_batches(self):
+        f = BytesIO()
+        writer = BatchWriter(f, flushsize=10)
+
+        writer.write("0.0.0.0 ", 0)
+        self.assertEqual(f.getvalue(), b"")
+
+        writer.write("a.com\n", 1)
+        self.assertEqual(f.getvalue(), b"0.0.0.0 a.com\n")
+
+        writer.write("# \u00e9\n")
+        writer.flush()
+        self.assertEqual(f.getvalue(), "0.0.0.0 a.com\n# \u00e9\n".encode("UTF-8"))
+
+        self.assertEqual(writer.byteswritten, 19)
+        self.assertEqual(writer.ruleswritten, 1)
+
+    def test_flush_on_exit(self):
+        f = BytesIO()
+
+        with BatchWriter(f) as writer:
+            writer.write("0.0.0.0 a.com b.com\n", 2)
+            self.assertEqual(f.getvalue(), b"")
+
+        self.assertEqual(f.getvalue(), b"0.0.0.0 a.com b.com\n")
+        self.assertEqual(writer.ruleswritten, 2)
+
+
+class TestProfile(Base):
+    def test_exclusive_times(self):
+        # Every reading of the clocks moves them one second forward.
+        with mock.patch("time.perf_counter", side_effect=itertools.count()):
+            with mock.patch("time.process_time", side_effect=itertools.count()):
+                profile = Profile()
+
+                # The lines are timed a chunk at a time: a full chunk, the
+                # last line and the end of the lines.
+                expected = [str(i) for i in range(PROFILE_CHUNK_SIZE + 1)]
+                with profile.stage("outer"):
+                    lines = list(profile.iterate(expected, "inner", "s.txt"))
+                profile.count("inner", "s.txt", bytes=4)
+
+                report = profile.report()
+
+        self.assertEqual(lines, expected)
+        self.assertEqual(report["wall"], 9)
+        self.assertEqual(report["cpu"], 9)
+
+        inner = {"wall": 3, "cpu": 3, "lines": len(expected), "bytes": 4}
+        self.assertEqual(
+            report["stages"], {"outer": {"wall": 4, "cpu": 4}, "inner": inner}
+        )
+        self.assertEqual(report["sources"], {"s.txt": {"inner": inner}})
+
+    def test_write(self):
+        profile = Profile()
+        with profile.stage("write"):
+            pass
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "profile.json")
+            profile.write(path)
+
+            with open(path) as f:
+                report = json.load(f)
+
+        self.assertEqual(list(report["stages"]), ["write"])
+        self.assertEqual(report["sources"], {})
+
+
+class TestMemoryTracker(Base):
+    def test_nested_stages(self):
+        tracker = MemoryTracker(topsites=1)
+        try:
+            with tracker.stage("outer"):
+                with tracker.stage("inner"):
+                    data = bytearray(4 * 1048576)
+                    tracker.checkpoint()
+                    del data
+        finally:
+            tracker.close()
+
+        inner = tracker.report()["inner"]
+        outer = tracker.report()["outer"]
+
+        self.assertGreaterEqual(inner["peak"], 4 * 1048576)
+        self.assertLess(inner["end"], 4 * 1048576)
+        self.assertGreaterEqual(outer["peak"], inner["peak"])
+
+        # The top allocation site is the one of the checkpoint, not the end.
+        self.assertEqual(len(inner["sites"]), 1)
+        self.assertTrue(inner["sites"][0]["site"].startswith("testUpdateHostsFile.py:"))
+        self.assertGreaterEqual(inner["sites"][0]["size"], 4 * 1048576)
+        self.assertEqual(outer["sites"], inner["sites"])
+
+        self.assertTrue(
+            tracker.summary().startswith("Memory high-water mark by stage:\n  inner: ")
+        )
+
+    def test_close(self):
+        tracker = MemoryTracker()
+        self.assertTrue(tracemalloc.is_tracing())
+
+        tracker.close()
+        self.assertFalse(tracemalloc.is_tracing())
+
+
 class TestQueryYesOrNo(BaseStdout):
     def test_invalid_default(self):
         for invalid_default in ["foo", "bar", "baz", 1, 2, 3]:
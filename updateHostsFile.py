@@ -7,8 +7,14 @@
 # as sources into one, unique host file to keep your internet browsing happy.
 
 import argparse
+import concurrent.futures
+import contextlib
 import fnmatch
+import functools
+import hashlib
+import io
 import ipaddress
+import itertools
 import json
 import locale
 import os
@@ -20,9 +26,12 @@ import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import tracemalloc
+from array import array
+from collections import deque
 from glob import glob
-from typing import Optional, Tuple
 
 # Detecting Python 3 for version-dependent implementations
 PY3 = sys.version_info >= (3, 0)
@@ -39,6 +48,12 @@ except ImportError:
         "https://docs.python-requests.org/en/latest/) is now required."
     )
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the RSS of --memory is not reported.
+    resource = None
+
 
 # Syntactic sugar for "sudo" command in UNIX / Linux
 if platform.system() == "OpenBSD":
@@ -52,6 +67,48 @@ else:
 # Project Settings
 BASEDIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# Sidecar of each update.json, which records the cache validators of the
+# last download of that source.
+SOURCE_CACHE_FILENAME = "update.cache.json"
+
+# Sidecar of each hosts file built with --skip-unchanged, which records the
+# build key of that hosts file.
+BUILD_CACHE_FILENAME = "build.cache.json"
+
+# Settings that determine the contents of a hosts file, besides its input
+# files, and so make up its build key.
+BUILD_KEY_SETTINGS = (
+    "targetip",
+    "keepdomaincomments",
+    "skipstatichosts",
+    "compress",
+    "minimise",
+    "domainsperline",
+    "collapsesubdomains",
+    "nounifiedhosts",
+    "extensions",
+    "outputsubfolder",
+    "exclusionpattern",
+)
+
+# Number of lines handed to a worker process at a time with --workers.
+PARSE_CHUNK_SIZE = 20000
+
+# Version of the parsing of the host files, to bump whenever parse_line or
+# normalize_rule change their results, so that --cache-dir is renewed.
+PARSE_CACHE_VERSION = 1
+
+# Hostnames of the static hosts at the top of the hosts file, which are never
+# repeated in its body.
+RESERVED_HOSTNAMES = ("localhost", "localhost.localdomain", "local", "broadcasthost")
+
+# Number of characters that a BatchWriter collects before writing them out,
+# and of bytes read or copied at a time.
+WRITE_BATCH_SIZE = 1 << 20
+
+# Number of lines of a stage timed at a time with --profile.
+PROFILE_CHUNK_SIZE = 4096
+
 
 def get_defaults():
     """
@@ -97,7 +154,28 @@ def get_defaults():
 # End Project Settings
 
 
-def main():
+def main(argv=None, sourcecache=None, variantmatrix=None):
+    """
+    Build a hosts file.
+
+    Parameters
+    ----------
+    argv : list, default None
+        The command line arguments, those of the script if None.
+    sourcecache : dict, default None
+        The cache of the parsed host files, shared between several builds
+        in the same process. See `parse_source`.
+    variantmatrix : VariantMatrix, default None
+        The variants built in the same process, to deduplicate them all at
+        once.
+
+    Returns
+    -------
+    readme_updates : dict
+        The information about the hosts file for the README JSON data, as
+        the readme_updates of `update_readme_data`.
+    """
+
     parser = argparse.ArgumentParser(
         description="Creates a unified hosts "
         "file from hosts stored in the data subfolders."
@@ -156,6 +234,14 @@ def main():
         action="store_true",
         help="Don't update from host data sources.",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of data sources to download concurrently. Default is 1.",
+    )
     parser.add_argument(
         "--skipstatichosts",
         "-s",
@@ -214,6 +300,94 @@ def main():
         help="Minimise the hosts file ignoring non-necessary lines "
         "(empty lines and comments).",
     )
+    parser.add_argument(
+        "--domains-per-line",
+        dest="domainsperline",
+        type=int,
+        default=9,
+        help="Maximum number of domains on each line of a compressed hosts "
+        "file. Default is 9.",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Number of processes parsing the hosts files. Default is 1.",
+    )
+    parser.add_argument(
+        "--parse-memo",
+        dest="parsememo",
+        type=int,
+        default=0,
+        help="Number of parsed lines to remember, so that the lines found in "
+        "several sources are only parsed once. Worth it when the sources "
+        "overlap a lot. Default is 0, which remembers none.",
+    )
+    parser.add_argument(
+        "--collapse-subdomains",
+        dest="collapsesubdomains",
+        default=False,
+        action="store_true",
+        help="Drop the domains whose parent domain is also blocked. Only "
+        "for resolvers that block the subdomains of a blocked domain.",
+    )
+    parser.add_argument(
+        "--dedup",
+        dest="dedup",
+        default="set",
+        choices=["set", "compact"],
+        help="How to store the hostnames seen while removing duplicates. "
+        "'compact' uses far less memory than the default 'set' on very "
+        "large inputs, at some cost in speed.",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        dest="skipunchanged",
+        default=False,
+        action="store_true",
+        help="Leave the hosts file and its README data as they are when "
+        "nothing it is built from changed since it was last built.",
+    )
+    parser.add_argument(
+        "--write-if-changed",
+        dest="writeifchanged",
+        default=False,
+        action="store_true",
+        help="Leave the hosts file untouched, date included, when only the "
+        "date in its header would change.",
+    )
+    parser.add_argument(
+        "--rejects-file",
+        dest="rejectsfile",
+        default=None,
+        help="File in which to write the invalid rules found in the host "
+        "files, each after the host file it comes from. The console only "
+        "shows how many there are.",
+    )
+    parser.add_argument(
+        "--memory",
+        dest="trackmemory",
+        default=False,
+        action="store_true",
+        help="Report the memory high-water mark of each stage of the build, "
+        "and where the most memory is allocated.",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profilefile",
+        default=None,
+        help="File in which to write a JSON report of the time spent in each "
+        "stage of the build, and of the lines and bytes that went through it, "
+        "overall and by source.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cachedir",
+        default=None,
+        help="Directory in which to keep the parsed host files, so that the "
+        "next runs only parse the host files that changed.",
+    )
     parser.add_argument(
         "--whitelist",
         "-w",
@@ -231,13 +405,33 @@ def main():
 
     global settings
 
-    options = vars(parser.parse_args())
+    options = vars(parser.parse_args(argv))
 
     options["outputpath"] = path_join_robust(BASEDIR_PATH, options["outputsubfolder"])
     options["freshen"] = not options["noupdate"]
 
     settings = get_defaults()
     settings.update(options)
+    settings["sourcecache"] = sourcecache
+    settings["variantmatrix"] = variantmatrix
+    settings["rejects"] = RejectedRules(keeprules=bool(settings["rejectsfile"]))
+    settings["memory"] = MemoryTracker() if settings["trackmemory"] else None
+    settings["profile"] = (
+        Profile(memory=settings["memory"]) if settings["profilefile"] else None
+    )
+
+    profile = settings["profile"]
+    memory = settings["memory"]
+
+    def stage(name):
+        # A stage of the build, recorded in the profile and memory tracker
+        # if any.
+        stack = contextlib.ExitStack()
+        if memory is not None:
+            stack.enter_context(memory.stage(name))
+        if profile is not None:
+            stack.enter_context(profile.stage(name))
+        return stack
 
     datapath = settings["datapath"]
     extensionspath = settings["extensionspath"]
@@ -261,7 +455,13 @@ def main():
 
     updatesources = prompt_for_update(freshen=settings["freshen"], updateauto=auto)
     if updatesources:
-        update_all_sources(sourcedatafilename, settings["hostfilename"])
+        with memory.stage("fetch") if memory else contextlib.nullcontext():
+            update_all_sources(
+                sourcedatafilename,
+                settings["hostfilename"],
+                jobs=settings["jobs"],
+                profile=profile,
+            )
 
     gatherexclusions = prompt_for_exclusions(skipprompt=auto)
 
@@ -284,67 +484,174 @@ def main():
         nounifiedhosts=nounifiedhosts,
     )
 
-    mergefile = create_initial_file(
+    outputsubfolder = settings["outputsubfolder"]
+    hostsfile_path = path_join_robust(settings["outputpath"], "hosts")
+    buildcache_path = path_join_robust(settings["outputpath"], BUILD_CACHE_FILENAME)
+
+    def finish(readme_updates):
+        # The reports, then moving the hosts file into place, whether it was
+        # just built or already up to date.
+        if profile is not None:
+            profile.write(settings["profilefile"])
+        if memory is not None:
+            print(memory.summary(), end="")
+            memory.close()
+
+        movefile = prompt_for_move(
+            hostsfile_path,
+            auto=auto,
+            replace=settings["replace"],
+            skipstatichosts=settings["skipstatichosts"],
+        )
+
+        # We only flush the DNS cache if we have
+        # moved a new hosts file into place.
+        if movefile:
+            prompt_for_flush_dns_cache(
+                flushcache=settings["flushdnscache"], promptflush=not auto
+            )
+
+        return readme_updates
+
+    buildkey = None
+    if settings["skipunchanged"]:
+        with stage("buildkey"):
+            buildkey = build_key(exclusionregexes, sourcesdata)
+        record = read_build_record(buildcache_path)
+
+        if record.get("key") == buildkey and record.get("sha256") == file_digest(
+            hostsfile_path
+        ):
+            print_success(
+                "The hosts file in folder ./"
+                + outputsubfolder
+                + " is up to date.\nIt contains "
+                + "{:,}".format(record["numberofrules"])
+                + " unique entries."
+            )
+
+            # Nothing to build, but the hosts file may still be moved into
+            # place.
+            return finish(
+                dict(
+                    extensions=extensions,
+                    numberofrules=record["numberofrules"],
+                    outputsubfolder=outputsubfolder,
+                    sourcesdata=sourcesdata,
+                    nounifiedhosts=nounifiedhosts,
+                )
+            )
+
+    mergelines = merge_parsed_lines(
         nounifiedhosts=nounifiedhosts,
     )
-    remove_old_hosts_file(settings["outputpath"], "hosts", settings["backup"])
-    with open(path_join_robust(settings["outputpath"], "hosts"), "w+b") as finalfile:
-        if settings["compress"] or settings["minimise"]:
-            with tempfile.NamedTemporaryFile() as tmpfile:
-                remove_dups_and_excl(mergefile, exclusionregexes, tmpfile)
-                if settings["compress"]:
-                    compress_file(tmpfile, settings["targetip"], finalfile)
-                else:
-                    minimise_file(tmpfile, settings["targetip"], finalfile)
-        else:
-            remove_dups_and_excl(mergefile, exclusionregexes, finalfile)
+    if profile is not None:
+        mergelines = profile.iterate(mergelines, "merge")
+
+    writeifchanged = settings["writeifchanged"]
+    os.makedirs(settings["outputpath"], exist_ok=True)
+
+    # The header needs the number of rules, so the body is written to a
+    # temporary file next to the hosts file first. The header and the body
+    # then go into a second one, which replaces the hosts file at once, so
+    # that the hosts file is never seen partly written.
+    bodyfile = tempfile.NamedTemporaryFile(
+        dir=settings["outputpath"], suffix=".tmp", delete=False
+    )
+    newfile = None
+    try:
+        with bodyfile:
+            with stage("deduplicate"):
+                remove_dups_and_excl(mergelines, exclusionregexes, bodyfile)
 
         numberofrules = settings["numberofrules"]
-        outputsubfolder = settings["outputsubfolder"]
         skipstatichosts = settings["skipstatichosts"]
 
-        write_opening_header(
-            finalfile,
-            extensions=extensions,
-            numberofrules=numberofrules,
-            outputsubfolder=outputsubfolder,
-            skipstatichosts=skipstatichosts,
-            nounifiedhosts=nounifiedhosts,
+        newfile = tempfile.NamedTemporaryFile(
+            dir=settings["outputpath"], suffix=".tmp", delete=False
         )
+        with newfile:
+            with stage("header"):
+                write_opening_header(
+                    newfile,
+                    extensions=extensions,
+                    numberofrules=numberofrules,
+                    outputsubfolder=outputsubfolder,
+                    skipstatichosts=skipstatichosts,
+                    nounifiedhosts=nounifiedhosts,
+                )
 
-    if not settings["nogendata"]:
-        update_readme_data(
-            settings["readmedatafilename"],
-            extensions=extensions,
-            numberofrules=numberofrules,
-            outputsubfolder=outputsubfolder,
-            sourcesdata=sourcesdata,
-            nounifiedhosts=nounifiedhosts,
+            with stage("write"):
+                with open(bodyfile.name, "rb") as body:
+                    shutil.copyfileobj(body, newfile, WRITE_BATCH_SIZE)
+
+        with stage("write"):
+            unchanged = False
+            if writeifchanged and os.path.isfile(hostsfile_path):
+                with open(hostsfile_path, "rb") as oldfile:
+                    with open(newfile.name, "rb") as builtfile:
+                        unchanged = hosts_file_digest(oldfile) == hosts_file_digest(
+                            builtfile
+                        )
+
+            # An unchanged hosts file is left untouched, date included.
+            if not unchanged:
+                replace_hosts_file(newfile.name, hostsfile_path, settings["backup"])
+    finally:
+        for tmpfile in (bodyfile, newfile):
+            if tmpfile is not None and os.path.exists(tmpfile.name):
+                os.remove(tmpfile.name)
+
+    if profile is not None and not unchanged:
+        profile.count("write", bytes=os.path.getsize(hostsfile_path))
+
+    if buildkey is not None:
+        write_build_record(
+            buildcache_path,
+            dict(
+                key=buildkey,
+                numberofrules=numberofrules,
+                sha256=file_digest(hostsfile_path),
+            ),
         )
 
+    readme_updates = dict(
+        extensions=extensions,
+        numberofrules=numberofrules,
+        outputsubfolder=outputsubfolder,
+        sourcesdata=sourcesdata,
+        nounifiedhosts=nounifiedhosts,
+    )
+
+    if not settings["nogendata"]:
+        with stage("readme"):
+            update_readme_data(settings["readmedatafilename"], **readme_updates)
+
     print_success(
-        "Success! The hosts file has been saved in folder "
-        + "./"
+        "Success! The hosts file "
+        + ("is unchanged in" if unchanged else "has been saved in")
+        + " folder ./"
         + outputsubfolder
         + "\nIt contains "
         + "{:,}".format(numberofrules)
         + " unique entries."
     )
 
-    movefile = prompt_for_move(
-        finalfile,
-        auto=auto,
-        replace=settings["replace"],
-        skipstatichosts=skipstatichosts,
-    )
+    print(settings["rejects"].summary(), end="")
 
-    # We only flush the DNS cache if we have
-    # moved a new hosts file into place.
-    if movefile:
-        prompt_for_flush_dns_cache(
-            flushcache=settings["flushdnscache"], promptflush=not auto
+    if settings["rejectsfile"]:
+        with open(settings["rejectsfile"], "w", encoding="UTF-8") as rejectsfile:
+            settings["rejects"].write(rejectsfile)
+
+    if settings["parsememo"]:
+        print(
+            "Parsed lines remembered so far: {:,} found, {:,} missed.".format(
+                parsememostats["hits"], parsememostats["misses"]
+            )
         )
 
+    return finish(readme_updates)
+
 
 # Prompt the User
 def prompt_for_update(freshen, updateauto):
@@ -454,8 +761,9 @@ def prompt_for_move(finalfile, **moveparams):
 
     Parameters
     ----------
-    finalfile : file
-        The file object that contains the newly created hosts data.
+    finalfile : file or str
+        The file object that contains the newly created hosts data, or the
+        path of that file.
     moveparams : kwargs
         Dictionary providing additional parameters for moving the hosts file
         into place. Currently, those fields are:
@@ -626,6 +934,75 @@ def exclude_domain(domain, exclusionpattern, exclusionregexes):
     return exclusionregexes
 
 
+# Domains excluded through `exclude_domain` with the default exclusion pattern.
+PLAIN_EXCLUSION_REGEX = re.compile(r"[a-zA-Z\d_-]+(?:\.[a-zA-Z\d_-]+)*")
+
+# Patterns that can't be wrapped into a larger alternation without changing
+# their meaning: backreferences, named groups and conditional groups.
+UNCOMBINABLE_PATTERN_REGEX = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(")
+
+
+def compile_exclusions(exclusionregexes, exclusionpattern=None):
+    """
+    Compile the exclusion regexes into a single matcher.
+
+    Regexes built by `exclude_domain` from `exclusionpattern` and a plain
+    domain are turned into a set of domains, which match a hostname that is
+    that domain or one of its subdomains. Every other regex is folded into
+    one alternation, so that a rule is searched once regardless of the
+    number of exclusions.
+
+    Parameters
+    ----------
+    exclusionregexes : list
+        The list of regex patterns used to exclude domains.
+    exclusionpattern : str, default None
+        The exclusion pattern with which the domain regexes were created.
+
+    Returns
+    -------
+    exclusions : tuple
+        A tuple of the set of excluded domains and the list of compiled
+        regexes that the remaining exclusions were combined into.
+    """
+
+    domains = set()
+    combinable = []
+    regexes = []
+
+    for exclusionregex in exclusionregexes:
+        pattern = exclusionregex.pattern
+
+        if (
+            exclusionpattern
+            and isinstance(pattern, str)
+            and pattern.startswith(exclusionpattern)
+            and PLAIN_EXCLUSION_REGEX.fullmatch(pattern[len(exclusionpattern):])
+        ):
+            domains.add(pattern[len(exclusionpattern):].lower())
+        elif (
+            isinstance(pattern, str)
+            and exclusionregex.flags == re.UNICODE
+            and not UNCOMBINABLE_PATTERN_REGEX.search(pattern)
+        ):
+            combinable.append(exclusionregex)
+        else:
+            regexes.append(exclusionregex)
+
+    if len(combinable) > 1:
+        try:
+            combinable = [
+                re.compile(
+                    "|".join("(?:" + regex.pattern + ")" for regex in combinable)
+                )
+            ]
+        except re.error:
+            # For instance, inline flags are only allowed at the very start.
+            pass
+
+    return domains, combinable + regexes
+
+
 def matches_exclusions(strippedrule, exclusionregexes):
     """
     Check whether a rule matches an exclusion rule we already provided.
@@ -637,8 +1014,9 @@ def matches_exclusions(strippedrule, exclusionregexes):
     ----------
     strippedrule : str
         The rule that we are checking.
-    exclusionregexes : list
-        The list of regex patterns used to exclude domains.
+    exclusionregexes : list or tuple
+        The list of regex patterns used to exclude domains, or the matcher
+        that `compile_exclusions` compiled them into.
 
     Returns
     -------
@@ -646,19 +1024,113 @@ def matches_exclusions(strippedrule, exclusionregexes):
         Whether or not the rule string matches a provided exclusion.
     """
 
+    if isinstance(exclusionregexes, list):
+        exclusionregexes = compile_exclusions(exclusionregexes)
+
+    domains, regexes = exclusionregexes
+
     try:
         strippeddpmain = strippedrule.split()[1]
     except IndexError:
         # Example: 'example.org' instead of '0.0.0.0 example.org'
         strippeddpmain = strippedrule
 
-    for exclusionRegex in exclusionregexes:
+    if domains:
+        hostname = strippeddpmain.lower()
+        if hostname in domains:
+            return True
+
+        dot = hostname.find(".")
+        while dot != -1:
+            if hostname[dot + 1 :] in domains:
+                return True
+            dot = hostname.find(".", dot + 1)
+
+    for exclusionRegex in regexes:
         if exclusionRegex.search(strippeddpmain):
             return True
 
     return False
 
 
+def compile_whitelist(exclusions):
+    """
+    Compile the whitelist entries for matching against hosts file lines.
+
+    Most entries are plain domains, which are kept in a set so that a line
+    is checked with one lookup per domain suffix of each of its words,
+    regardless of the size of the whitelist. The rare entries containing
+    whitespace are combined into a single regex.
+
+    Parameters
+    ----------
+    exclusions : list
+        The whitelist entries.
+
+    Returns
+    -------
+    whitelist : tuple
+        A tuple of the set of plain entries and the compiled regex for the
+        other entries, or None if there are no other entries.
+    """
+
+    domains = set()
+    patterns = []
+
+    for exclude in exclusions:
+        if exclude.split() == [exclude]:
+            domains.add(exclude)
+        else:
+            patterns.append(re.escape(exclude))
+
+    regex = None
+    if patterns:
+        regex = re.compile(r"(^|[\s\.])(" + "|".join(patterns) + r")\s")
+
+    return domains, regex
+
+
+def matches_whitelist(line, whitelist):
+    """
+    Check whether a hosts file line matches a whitelist entry.
+
+    An entry matches a word of the line, or the end of a word right after
+    a dot, when that word is followed by whitespace. For instance, the
+    entry "example.com" matches "0.0.0.0 ads.example.com\n".
+
+    Parameters
+    ----------
+    line : str
+        The line that we are checking.
+    whitelist : tuple
+        The whitelist, as compiled by `compile_whitelist`.
+
+    Returns
+    -------
+    matches_whitelist : bool
+        Whether or not the line matches a whitelist entry.
+    """
+
+    domains, regex = whitelist
+
+    if domains:
+        words = line.split()
+        if words and not line[-1].isspace():
+            words.pop()
+
+        for word in words:
+            if word in domains:
+                return True
+
+            dot = word.find(".")
+            while dot != -1:
+                if word[dot + 1 :] in domains:
+                    return True
+                dot = word.find(".", dot + 1)
+
+    return regex is not None and regex.search(line) is not None
+
+
 # End Exclusion Logic
 
 
@@ -732,7 +1204,7 @@ def jsonarray(json_array_string):
     return hostlines
 
 
-def update_all_sources(sourcedatafilename, hostfilename):
+def update_all_sources(sourcedatafilename, hostfilename, jobs=1, profile=None):
     """
     Update all host files, regardless of folder depth.
 
@@ -746,191 +1218,1143 @@ def update_all_sources(sourcedatafilename, hostfilename):
         The name of the file in which the updated source information
         is stored for a particular URL. This filename is assumed to be
         the same for all sources.
+    jobs : int, default 1
+        The number of sources to download concurrently. Each source is
+        written as soon as its own download completes.
+    profile : Profile, default None
+        The profile in which to record the download of each source, if any.
+    """
+
+    allsources = sort_sources(recursive_glob("*", sourcedatafilename))
+
+    def update(source):
+        if profile is None:
+            return update_source(source, hostfilename)
+
+        sourcedir = os.path.dirname(source)
+        with profile.stage("fetch", sourcedir):
+            update_source(source, hostfilename, profile)
+
+        hostsfile_path = path_join_robust(BASEDIR_PATH, sourcedir, hostfilename)
+        if os.path.isfile(hostsfile_path):
+            profile.count(
+                "fetch", sourcedir, bytes=os.path.getsize(hostsfile_path)
+            )
+
+    if jobs > 1 and len(allsources) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(update, source) for source in allsources]
+
+            for future in futures:
+                future.result()
+    else:
+        for source in allsources:
+            update(source)
+
+
+def update_source(source, hostfilename, profile=None):
+    """
+    Update the host file of a single source from its URL.
+
+    Parameters
+    ----------
+    source : str
+        The path of the file where information regarding updating the
+        source is stored.
+    hostfilename : str
+        The name of the file in which the updated source information
+        is stored.
+    profile : Profile, default None
+        The profile in which to record the download, if any.
     """
 
     # The transforms we support
     transformmethods = {"jsonarray": jsonarray}
 
-    allsources = sort_sources(recursive_glob("*", sourcedatafilename))
+    updatefile = open(source, "r", encoding="UTF-8")
+    updatedata = json.load(updatefile)
+    updatefile.close()
 
-    for source in allsources:
-        updatefile = open(source, "r", encoding="UTF-8")
-        updatedata = json.load(updatefile)
-        updatefile.close()
+    # we can pause updating any given hosts source.
+    # if the update.json "pause" key is missing, don't pause.
+    if updatedata.get("pause", False):
+        return
 
-        # we can pause updating any given hosts source.
-        # if the update.json "pause" key is missing, don't pause.
-        if updatedata.get("pause", False):
-            continue
+    updateurl = updatedata["url"]
+    update_transforms = []
+    if updatedata.get("transforms"):
+        update_transforms = updatedata["transforms"]
 
-        updateurl = updatedata["url"]
-        update_transforms = []
-        if updatedata.get("transforms"):
-            update_transforms = updatedata["transforms"]
+    print("Updating source " + os.path.dirname(source) + " from " + updateurl)
 
-        print("Updating source " + os.path.dirname(source) + " from " + updateurl)
+    hostsfile_path = path_join_robust(
+        BASEDIR_PATH, os.path.dirname(source), hostfilename
+    )
+    cachefile_path = path_join_robust(
+        BASEDIR_PATH, os.path.dirname(source), SOURCE_CACHE_FILENAME
+    )
 
-        try:
-            updatedfile = get_file_by_url(updateurl)
+    # The validators are only meaningful for the hosts file they describe.
+    cached_validators = {}
+    if os.path.isfile(hostsfile_path):
+        cached_validators = read_source_validators(cachefile_path)
+
+    try:
+        updatedfile, validators = get_source_by_url(
+            updateurl, cached_validators, profile
+        )
 
-            # spin the transforms as required
-            for transform in update_transforms:
-                updatedfile = transformmethods[transform](updatedfile)
+        if updatedfile is None:
+            print("Source " + os.path.dirname(source) + " is unchanged")
 
-            # get rid of carriage-return symbols
-            updatedfile = updatedfile.replace("\r", "")
+            if validators != cached_validators:
+                write_source_validators(cachefile_path, validators)
+            return
 
-            hostsfile = open(
-                path_join_robust(BASEDIR_PATH, os.path.dirname(source), hostfilename),
-                "wb",
-            )
-            write_data(hostsfile, updatedfile)
-            hostsfile.close()
-        except Exception:
-            print("Error in updating source: ", updateurl)
+        # spin the transforms as required
+        for transform in update_transforms:
+            updatedfile = transformmethods[transform](updatedfile)
+
+        # get rid of carriage-return symbols
+        updatedfile = updatedfile.replace("\r", "")
+
+        hostsfile = open(hostsfile_path, "wb")
+        write_data(hostsfile, updatedfile)
+        hostsfile.close()
+
+        write_source_validators(cachefile_path, validators)
+    except Exception:
+        print("Error in updating source: ", updateurl)
+
+
+def read_source_validators(cachefile_path):
+    """
+    Read the cache validators recorded for the last download of a source.
+
+    Parameters
+    ----------
+    cachefile_path : str
+        The path of the sidecar file in which the validators are stored.
+
+    Returns
+    -------
+    validators : dict
+        The "etag", "lastmodified" and "sha256" validators of the last
+        download, or an empty dictionary if none are recorded.
+    """
+
+    if not os.path.isfile(cachefile_path):
+        return {}
+
+    try:
+        with open(cachefile_path, "r", encoding="UTF-8") as cachefile:
+            return json.load(cachefile)
+    except ValueError:
+        # A damaged sidecar simply means a full download.
+        return {}
+
+
+def write_source_validators(cachefile_path, validators):
+    """
+    Record the cache validators of the last download of a source.
+
+    Parameters
+    ----------
+    cachefile_path : str
+        The path of the sidecar file in which the validators are stored.
+    validators : dict
+        The validators to record.
+    """
+
+    with open(cachefile_path, "w", encoding="UTF-8") as cachefile:
+        json.dump(validators, cachefile, indent=2, sort_keys=True)
 
 
 # End Update Logic
 
 
 # File Logic
-def create_initial_file(**initial_file_params):
+def list_initial_files(**initial_file_params):
     """
-    Initialize the file in which we merge all host files for later pruning.
+    List the host files that we merge, in the order in which they are merged.
 
     Parameters
     ----------
-    headerparams : kwargs
+    initial_file_params : kwargs
         Dictionary providing additional parameters for populating the initial file
         information. Currently, those fields are:
 
         1) nounifiedhosts
+        2) extensions: optional, the extensions to merge instead of those
+           of the settings.
+
+    Returns
+    -------
+    initial_files : list
+        A list of tuples of the path of each file, its encoding (None for
+        the default one), for the base sources the name that marks the
+        start and end of the source (None otherwise), and the group of the
+        file: "" for the base sources, the name of the extension for the
+        extensions and None for the blacklist.
     """
 
-    mergefile = tempfile.NamedTemporaryFile()
+    initial_files = []
 
     if not initial_file_params["nounifiedhosts"]:
         # spin the sources for the base file
         for source in sort_sources(
             recursive_glob(settings["datapath"], settings["hostfilename"])
         ):
-            start = "# Start {}\n\n".format(os.path.basename(os.path.dirname(source)))
-            end = "\n# End {}\n\n".format(os.path.basename(os.path.dirname(source)))
-
-            with open(source, "r", encoding="UTF-8") as curFile:
-                write_data(mergefile, start + curFile.read() + end)
+            name = os.path.basename(os.path.dirname(source))
+            initial_files.append((source, "UTF-8", name, ""))
 
     # spin the sources for extensions to the base file
-    for source in settings["extensions"]:
+    for source in initial_file_params.get("extensions", settings["extensions"]):
         for filename in sort_sources(
             recursive_glob(
                 path_join_robust(settings["extensionspath"], source),
                 settings["hostfilename"],
             )
         ):
-            with open(filename, "r") as curFile:
-                write_data(mergefile, curFile.read())
+            initial_files.append((filename, None, None, source))
 
     maybe_copy_example_file(settings["blacklistfile"])
 
     if os.path.isfile(settings["blacklistfile"]):
-        with open(settings["blacklistfile"], "r") as curFile:
-            write_data(mergefile, curFile.read())
+        initial_files.append((settings["blacklistfile"], None, None, None))
 
-    return mergefile
+    return initial_files
 
 
-def compress_file(inputfile, targetip, outputfile):
+def start_marker_lines(name):
     """
-    Reduce the file dimension removing non-necessary lines (empty lines and
-    comments) and putting multiple domains in each line.
-    Reducing the number of lines of the file, the parsing under Microsoft
-    Windows is much faster.
-
-    Parameters
-    ----------
-    inputfile : file
-        The file object that contains the hostnames that we are reducing.
-    targetip : str
-        The target IP address.
-    outputfile : file
-        The file object that will contain the reduced hostnames.
+    Get the lines that mark the start of a base source in the merged files.
     """
 
-    inputfile.seek(0)  # reset file pointer
-    write_data(outputfile, "\n")
+    return ["# Start {}\n".format(name), "\n"]
 
-    targetip_len = len(targetip)
-    lines = [targetip]
-    lines_index = 0
-    for line in inputfile.readlines():
-        line = line.decode("UTF-8")
 
-        if line.startswith(targetip):
-            if lines[lines_index].count(" ") < 9:
-                lines[lines_index] += (
-                    " " + line[targetip_len : line.find("#")].strip()  # noqa: E203
-                )
-            else:
-                lines[lines_index] += "\n"
-                lines.append(line[: line.find("#")].strip())
-                lines_index += 1
+def end_marker_lines(name):
+    """
+    Get the lines that mark the end of a base source in the merged files.
 
-    for line in lines:
-        write_data(outputfile, line)
+    The end marker starts with a newline, which either terminates the last
+    line of the source or leaves an empty line behind it.
+    """
 
-    inputfile.close()
+    return ["\n", "# End {}\n".format(name), "\n"]
 
 
-def minimise_file(inputfile, targetip, outputfile):
+def parse_source(filename, encoding, executor=None):
     """
-    Reduce the file dimension removing non-necessary lines (empty lines and
-    comments).
+    Parse the lines of a host file.
+
+    When a source cache is set up in the settings, the parsed lines of each
+    file are kept there, so that building several variants of the hosts
+    file in the same process parses every file only once. The cache entry
+    of a file is renewed when the file or the parsing settings change.
+
+    When a cache directory is set up in the settings, the parsed lines of
+    each file are also stored there, so that the next builds only parse the
+    files whose contents changed since.
 
     Parameters
     ----------
-    inputfile : file
-        The file object that contains the hostnames that we are reducing.
-    targetip : str
-        The target IP address.
-    outputfile : file
-        The file object that will contain the reduced hostnames.
+    filename : str
+        The path of the file to parse.
+    encoding : str
+        The encoding of the file, or None for the default one.
+    executor : concurrent.futures.ProcessPoolExecutor, default None
+        The process pool in which to parse the lines, if any.
+
+    Returns
+    -------
+    parsed_lines : iterable
+        The parsed lines of the file, as returned by `parse_line`.
     """
 
-    inputfile.seek(0)  # reset file pointer
-    write_data(outputfile, "\n")
+    targetip = settings["targetip"]
+    keepdomaincomments = settings["keepdomaincomments"]
 
-    lines = []
-    for line in inputfile.readlines():
-        line = line.decode("UTF-8")
+    def parse(lines):
+        if executor is None:
+            return parse_lines(
+                lines, targetip, keepdomaincomments, settings.get("parsememo", 0)
+            )
+        return parse_lines_in_parallel(lines, executor, settings["workers"])
+
+    def parse_file():
+        with open(filename, "r", encoding=encoding) as curFile:
+            yield from parse(curFile)
+
+    sourcecache = settings.get("sourcecache")
+    cachedir = settings.get("cachedir")
+    if sourcecache is None and not cachedir:
+        return parse_file()
+
+    if sourcecache is not None:
+        stat = os.stat(filename)
+        signature = (
+            stat.st_mtime_ns,
+            stat.st_size,
+            encoding,
+            targetip,
+            keepdomaincomments,
+        )
 
-        if line.startswith(targetip):
-            lines.append(line[: line.find("#")].strip() + "\n")
+        cached = sourcecache.get(filename)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
 
-    for line in lines:
-        write_data(outputfile, line)
+    if cachedir:
+        with open(filename, "rb") as curFile:
+            data = curFile.read()
+
+        # Decode the way open() does in text mode, newlines included.
+        lines = io.StringIO(
+            data.decode(encoding or locale.getpreferredencoding(False)), newline=None
+        ).readlines()
+
+        key = "{}:{}".format(hashlib.sha256(data).hexdigest(), PARSE_CACHE_VERSION)
+        cachefile_path = parse_cache_path(
+            cachedir, filename, encoding, targetip, keepdomaincomments
+        )
 
-    inputfile.close()
+        parsedlines = read_parse_cache(cachefile_path, key, lines)
+        if parsedlines is None:
+            parsedlines = list(parse(lines))
+            write_parse_cache(cachefile_path, key, parsedlines)
+    else:
+        parsedlines = list(parse_file())
+
+    if sourcecache is not None:
+        sourcecache[filename] = (signature, parsedlines)
 
+    return parsedlines
 
-def remove_dups_and_excl(mergefile, exclusionregexes, finalfile):
+
+def parse_cache_path(cachedir, filename, encoding, targetip, keepdomaincomments):
     """
-    Remove duplicates and remove hosts that we are excluding.
+    Get the path of the file in which the parsed lines of a host file are
+    stored within the cache directory.
 
-    We check for duplicate hostnames as well as remove any hostnames that
-    have been explicitly excluded by the user.
+    Each host file has a cache file per parsing settings, so that building
+    hosts files with other settings does not renew each other's entries.
 
     Parameters
     ----------
-    mergefile : file
-        The file object that contains the hostnames that we are pruning.
-    exclusionregexes : list
-        The list of regex patterns used to exclude domains.
-    finalfile : file
-        The file object in which the result is written.
+    cachedir : str
+        The cache directory.
+    filename : str
+        The path of the host file.
+    encoding : str
+        The encoding of the host file, or None for the default one.
+    targetip : str
+        The target IP address.
+    keepdomaincomments : bool
+        Whether or not to keep the comments after the rules.
+
+    Returns
+    -------
+    cachefile_path : str
+        The path of the cache file of that host file.
     """
 
-    numberofrules = settings["numberofrules"]
+    name = "\0".join(
+        (os.path.abspath(filename), str(encoding), targetip, str(keepdomaincomments))
+    )
+    return os.path.join(
+        cachedir, hashlib.sha256(name.encode("UTF-8")).hexdigest() + ".json"
+    )
+
+
+def read_parse_cache(cachefile_path, key, lines):
+    """
+    Read the parsed lines of a host file from the cache directory.
+
+    The cache file only stores what `parse_line` derives from each line, as
+    None for the lines that are skipped, 0 for the comments and blank lines,
+    and the stripped rule, hostname and normalized rule of the rules.
+
+    Parameters
+    ----------
+    cachefile_path : str
+        The path of the cache file of the host file.
+    key : str
+        The key of the contents of the host file and of the parsing version.
+    lines : list
+        The lines of the host file.
+
+    Returns
+    -------
+    parsed_lines : list
+        The parsed lines of the host file, or None if the cache file is
+        missing, damaged or stored for another key.
+    """
+
+    if not os.path.isfile(cachefile_path):
+        return None
+
+    try:
+        with open(cachefile_path, "r", encoding="UTF-8") as cachefile:
+            cached = json.load(cachefile)
+    except ValueError:
+        # A damaged cache file simply means parsing the host file again.
+        return None
+
+    if (
+        not isinstance(cached, dict)
+        or cached.get("key") != key
+        or len(cached.get("lines", ())) != len(lines)
+    ):
+        return None
+
+    parsedlines = []
+    for line, entry in zip(lines, cached["lines"]):
+        if entry is None:
+            parsedlines.append((line, None, None, None))
+        elif entry == 0:
+            parsedlines.append(
+                (line, None, None, line.replace("\t+", " ").rstrip(" ."))
+            )
+        else:
+            parsedlines.append((line,) + tuple(entry))
+
+    return parsedlines
+
+
+def write_parse_cache(cachefile_path, key, parsedlines):
+    """
+    Store the parsed lines of a host file in the cache directory.
+
+    The cache file is replaced at once, so that hosts files built at the
+    same time never read a partly written one.
+
+    Parameters
+    ----------
+    cachefile_path : str
+        The path of the cache file of the host file.
+    key : str
+        The key of the contents of the host file and of the parsing version.
+    parsedlines : list
+        The parsed lines of the host file, as returned by `parse_line`.
+    """
+
+    entries = []
+    for _, strippedrule, hostname, data in parsedlines:
+        if strippedrule is not None:
+            entries.append([strippedrule, hostname, data])
+        elif data is not None:
+            entries.append(0)
+        else:
+            entries.append(None)
+
+    cachedir = os.path.dirname(cachefile_path)
+    os.makedirs(cachedir, exist_ok=True)
+
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="UTF-8", dir=cachedir, suffix=".tmp", delete=False
+    ) as cachefile:
+        json.dump({"key": key, "lines": entries}, cachefile, separators=(",", ":"))
+
+    os.replace(cachefile.name, cachefile_path)
+
+
+def parse_initial_files(initial_files, executor=None):
+    """
+    Parse the lines of host files that we merge, with `parse_source`.
+
+    The lines of a file without a trailing newline are not joined with
+    those of the next file here; see `join_parsed_lines`.
+
+    Parameters
+    ----------
+    initial_files : list
+        The files, as listed by `list_initial_files`.
+    executor : concurrent.futures.ProcessPoolExecutor, default None
+        The process pool in which to parse the lines, if any.
+
+    Yields
+    ------
+    parsed_line : tuple
+        The next parsed line, as returned by `parse_line`.
+    """
+
+    targetip = settings["targetip"]
+    keepdomaincomments = settings["keepdomaincomments"]
+
+    rejects = settings.get("rejects")
+
+    for filename, encoding, name, _ in initial_files:
+        if rejects is not None:
+            rejects.source = os.path.relpath(filename, BASEDIR_PATH)
+
+        if name is not None:
+            yield from parse_lines(
+                start_marker_lines(name), targetip, keepdomaincomments
+            )
+
+        parsedlines = parse_source(filename, encoding, executor)
+
+        profile = settings.get("profile")
+        if profile is not None:
+            source = os.path.relpath(filename, BASEDIR_PATH)
+            profile.count("parse", source, bytes=os.path.getsize(filename))
+            parsedlines = profile.iterate(parsedlines, "parse", source)
+
+        yield from parsedlines
+
+        if name is not None:
+            yield from parse_lines(end_marker_lines(name), targetip, keepdomaincomments)
+
+
+def join_parsed_lines(parsedlines):
+    """
+    Join the parsed lines of files that don't end with a newline with the
+    first line of the next file.
+
+    As when the files are concatenated, the last line of such a file is
+    parsed again with the start of the next one.
+
+    The invalid rules of the joined lines are collected in the rejects of
+    the settings, if any, as coming from the source that `parse_initial_files`
+    is parsing.
+
+    Parameters
+    ----------
+    parsedlines : iterable
+        The parsed lines of the files, as returned by `parse_line`.
+
+    Yields
+    ------
+    parsed_line : tuple
+        The next parsed line. Only the last one may not end with a newline.
+    """
+
+    targetip = settings["targetip"]
+    keepdomaincomments = settings["keepdomaincomments"]
+
+    rejects = settings.get("rejects")
+
+    pending = ""
+    for parsed_line in parsedlines:
+        if pending:
+            parsed_line = parse_line(
+                pending + parsed_line[0], targetip, keepdomaincomments
+            )
+            pending = ""
+
+        if parsed_line[0].endswith("\n"):
+            if rejects is not None and parsed_line[1] and parsed_line[2] is None:
+                rejects.add(parsed_line[1])
+            yield parsed_line
+        else:
+            pending = parsed_line[0]
+
+    if pending:
+        parsed_line = parse_line(pending, targetip, keepdomaincomments)
+        if rejects is not None and parsed_line[1] and parsed_line[2] is None:
+            rejects.add(parsed_line[1])
+        yield parsed_line
+
+
+def merge_parsed_lines(**initial_file_params):
+    """
+    Stream the parsed lines of all host files that we merge for later pruning.
+
+    The result is the same as parsing the lines of all the files merged
+    together, with the start and end markers of the base sources, but each
+    file is parsed on its own, with `parse_source`.
+
+    Parameters
+    ----------
+    initial_file_params : kwargs
+        Dictionary providing additional parameters for populating the initial file
+        information. Currently, those fields are:
+
+        1) nounifiedhosts
+
+    Yields
+    ------
+    parsed_line : tuple
+        The next parsed line, as returned by `parse_line`.
+    """
+
+    executor = None
+    if settings["workers"] > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings["workers"],
+            initializer=init_parse_worker,
+            initargs=(
+                settings["targetip"],
+                settings["keepdomaincomments"],
+                settings.get("parsememo", 0),
+            ),
+        )
+
+    try:
+        yield from join_parsed_lines(
+            parse_initial_files(list_initial_files(**initial_file_params), executor)
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+class RejectedRules(object):
+    """
+    Collect the invalid rules found while merging the host files, to report
+    them all at once instead of one at a time.
+
+    Parameters
+    ----------
+    keeprules : bool, default False
+        Whether to keep the rules themselves, for `write`, or only count
+        them.
+    """
+
+    def __init__(self, keeprules=False):
+        self.source = None
+        self.counts = {}
+        self.rules = [] if keeprules else None
+
+    def add(self, rule):
+        """
+        Collect an invalid rule of the current source.
+
+        Parameters
+        ----------
+        rule : str
+            The rule, as stripped by `strip_rule`.
+        """
+
+        self.counts[self.source] = self.counts.get(self.source, 0) + 1
+        if self.rules is not None:
+            self.rules.append((self.source, rule))
+
+    def update(self, other):
+        """
+        Collect the invalid rules collected by other rejected rules.
+
+        Parameters
+        ----------
+        other : RejectedRules
+            The rejected rules to collect, which must keep their rules if
+            these rejected rules do.
+        """
+
+        for source, count in other.counts.items():
+            self.counts[source] = self.counts.get(source, 0) + count
+        if self.rules is not None:
+            self.rules.extend(other.rules)
+
+    def summary(self):
+        """
+        Summarize the invalid rules found, by source.
+
+        Returns
+        -------
+        summary : str
+            The number of invalid rules of each source, or an empty string if
+            none was found.
+        """
+
+        if not self.counts:
+            return ""
+
+        return "Skipped {:,} invalid rules:\n".format(
+            sum(self.counts.values())
+        ) + "".join(
+            "  {}: {:,}\n".format(source, count)
+            for source, count in self.counts.items()
+        )
+
+    def write(self, f):
+        """
+        Write the invalid rules found, each after the source it comes from.
+
+        Parameters
+        ----------
+        f : file
+            The text file object to write to.
+        """
+
+        f.write(
+            "".join(
+                "{}\t{}\n".format(source, rule) for source, rule in self.rules or ()
+            )
+        )
+
+
+def compress_lines(lines, targetip, domainsperline=9):
+    """
+    Put the domains of the rules of a hosts file on as few lines as possible.
+
+    Each line is handed out as soon as it is full, so that the lines never
+    have to be held in memory.
+
+    Parameters
+    ----------
+    lines : iterable
+        The lines of the hosts file that we are reducing.
+    targetip : str
+        The target IP address.
+    domainsperline : int
+        The maximum number of domains on each line.
+
+    Yields
+    ------
+    line : str
+        The next line of the reduced hosts file. It starts with an empty
+        line, and the last line has no newline.
+    """
+
+    yield "\n"
+
+    targetip_len = len(targetip)
+    packed = targetip
+    spaces = packed.count(" ")
+
+    for line in lines:
+        if not line.startswith(targetip):
+            continue
+
+        if spaces < domainsperline:
+            domain = line[targetip_len : line.find("#")].strip()  # noqa: E203
+            packed += " " + domain
+            spaces += 1 + domain.count(" ")
+        else:
+            yield packed + "\n"
+
+            packed = line[: line.find("#")].strip()
+            spaces = packed.count(" ")
+
+    yield packed
+
+
+def minimise_lines(lines, targetip):
+    """
+    Leave out the lines of a hosts file that are not rules, and the
+    comments after the rules.
+
+    Parameters
+    ----------
+    lines : iterable
+        The lines of the hosts file that we are reducing.
+    targetip : str
+        The target IP address.
+
+    Yields
+    ------
+    line : str
+        The next line of the reduced hosts file, which starts with an empty
+        line.
+    """
+
+    yield "\n"
+
+    for line in lines:
+        if line.startswith(targetip):
+            yield line[: line.find("#")].strip() + "\n"
+
+
+def compile_filters(filters):
+    """
+    Compile the post.json filters into an Aho-Corasick automaton.
+
+    The automaton finds any of the filter substrings in a single scan of a
+    line, however many filters there are.
+
+    Parameters
+    ----------
+    filters : list
+        The substrings that filter out the lines containing them.
+
+    Returns
+    -------
+    automaton : tuple
+        A tuple of the transitions of each state, as a list of dictionaries
+        mapping a character to the next state, and the index of the filter
+        found when reaching each state, or -1 if there is none.
+    """
+
+    transitions = [{}]
+    found = [-1]
+
+    for index, post_filter in enumerate(filters):
+        state = 0
+        for character in post_filter:
+            nextstate = transitions[state].get(character)
+            if nextstate is None:
+                transitions.append({})
+                found.append(-1)
+                nextstate = len(transitions) - 1
+                transitions[state][character] = nextstate
+            state = nextstate
+
+        if found[state] == -1:
+            found[state] = index
+
+    # Breadth-first, so that the fallback state of each state (its longest
+    # proper suffix that is also a prefix of a filter) is always complete by
+    # the time it is needed. Missing transitions are then filled in from the
+    # fallback state, which spares the matching loop from following it.
+    fallback = [0] * len(transitions)
+    queue = deque(transitions[0].values())
+
+    while queue:
+        state = queue.popleft()
+        if found[state] == -1:
+            found[state] = found[fallback[state]]
+
+        for character, nextstate in list(transitions[state].items()):
+            queue.append(nextstate)
+            if state:
+                fallback[nextstate] = transitions[fallback[state]].get(character, 0)
+
+        for character, nextstate in transitions[fallback[state]].items():
+            transitions[state].setdefault(character, nextstate)
+
+    return transitions, found
+
+
+def match_filters(line, automaton):
+    """
+    Find the post.json filter that a line contains, if any.
+
+    Parameters
+    ----------
+    line : str
+        The line that we are checking.
+    automaton : tuple
+        The filters, as compiled by `compile_filters`.
+
+    Returns
+    -------
+    matched_filter : int or None
+        The index of the first filter found in the line, or None if the line
+        contains none of the filters.
+    """
+
+    transitions, found = automaton
+
+    if found[0] != -1:
+        # An empty filter is found in any line.
+        return found[0]
+
+    state = 0
+    for character in line:
+        state = transitions[state].get(character, 0)
+        if found[state] != -1:
+            return found[state]
+
+    return None
+
+
+def parse_line(line, targetip, keepdomaincomments):
+    """
+    Parse a line of the merged host files, independently of the variant of
+    the hosts file that we are building.
+
+    Parameters
+    ----------
+    line : str
+        The line to parse.
+    targetip : str
+        The target IP address.
+    keepdomaincomments : bool
+        Whether or not to keep the comments after the rules.
+
+    Returns
+    -------
+    parsed_line : tuple
+        A tuple of the line itself, the rule stripped of its comments, the
+        hostname and the normalized rule (None if the rule is invalid). For
+        comments and blank lines, the rule and hostname are None and the
+        last item is the line to keep. Lines that are never kept only have
+        the line itself.
+    """
+
+    # replace tabs with space
+    strippedline = line.replace("\t+", " ")
+
+    # see gh-271: trim trailing whitespace, periods
+    strippedline = strippedline.rstrip(" .")
+
+    # Testing the first character doesn't require startswith. The last line
+    # of a file is parsed on its own, so it may be stripped down to nothing.
+    if (
+        not strippedline
+        or strippedline[0] == "#"
+        or re.match(r"^\s*$", strippedline[0])
+    ):
+        return line, None, None, strippedline
+    if "::1" in strippedline:
+        return line, None, None, None
+
+    strippedrule = strip_rule(strippedline)  # strip comments
+
+    # Issue #1628
+    if not strippedrule or "@" in strippedrule:
+        return line, None, None, None
+
+    # Normalize rule
+    hostname, normalized_rule = normalize_rule(
+        strippedrule,
+        targetip=targetip,
+        keep_domain_comments=keepdomaincomments,
+    )
+
+    return line, strippedrule, hostname, normalized_rule
+
+
+# The lines remembered by `parse_lines`, by target IP address and
+# keepdomaincomments setting, and the number of lines found there or not.
+parsememo = {}
+parsememostats = {"hits": 0, "misses": 0}
+
+
+def parse_lines(lines, targetip, keepdomaincomments, memosize=0):
+    """
+    Parse the lines of the merged host files with `parse_line`.
+
+    Parameters
+    ----------
+    lines : iterable
+        The lines to parse.
+    targetip : str
+        The target IP address.
+    keepdomaincomments : bool
+        Whether or not to keep the comments after the rules.
+    memosize : int, default 0
+        The number of parsed lines to remember, so that a line found in
+        several sources is only parsed once. The memo is shared by all the
+        calls in the process, and emptied when full. 0 disables it.
+
+    Yields
+    ------
+    parsed_line : tuple
+        The next parsed line, as returned by `parse_line`.
+    """
+
+    if not memosize:
+        for line in lines:
+            yield parse_line(line, targetip, keepdomaincomments)
+        return
+
+    memo = parsememo.setdefault((targetip, keepdomaincomments), {})
+    hits = misses = 0
+
+    try:
+        for line in lines:
+            parsedline = memo.get(line)
+
+            if parsedline is None:
+                misses += 1
+                parsedline = parse_line(line, targetip, keepdomaincomments)
+
+                if len(memo) >= memosize:
+                    memo.clear()
+                memo[line] = parsedline
+            else:
+                hits += 1
+
+            yield parsedline
+    finally:
+        parsememostats["hits"] += hits
+        parsememostats["misses"] += misses
+
+
+# The parameters of `parse_lines` in a worker process of `parse_lines_in_parallel`.
+workerparseparams = None
+
+
+def init_parse_worker(targetip, keepdomaincomments, memosize=0):
+    """
+    Initialize a worker process of `parse_lines_in_parallel`.
+
+    Parameters
+    ----------
+    targetip : str
+        The target IP address.
+    keepdomaincomments : bool
+        Whether or not to keep the comments after the rules.
+    memosize : int, default 0
+        The number of parsed lines to remember in the worker process.
+    """
+
+    global workerparseparams
+    workerparseparams = (targetip, keepdomaincomments, memosize)
+
+
+def parse_chunk(lines):
+    """
+    Parse a chunk of lines in a worker process of `parse_lines_in_parallel`.
+
+    Parameters
+    ----------
+    lines : list
+        The lines to parse.
+
+    Returns
+    -------
+    parsed_chunk : tuple
+        A tuple of the parsed lines, and the number of lines found in the
+        memo of the worker process or not, as counted in `parsememostats`.
+    """
+
+    hits, misses = parsememostats["hits"], parsememostats["misses"]
+    parsedlines = list(parse_lines(lines, *workerparseparams))
+
+    return (
+        parsedlines,
+        parsememostats["hits"] - hits,
+        parsememostats["misses"] - misses,
+    )
+
+
+def parse_lines_in_parallel(lines, executor, workers):
+    """
+    Parse lines like `parse_lines`, spread over several processes.
+
+    The lines are split into chunks that are parsed in a process pool, and
+    the parsed lines are yielded back in their original order, so that the
+    result is exactly the same as with `parse_lines`. The lines found in the
+    memos of the worker processes or not are added to `parsememostats`.
+
+    Parameters
+    ----------
+    lines : iterable
+        The lines to parse.
+    executor : concurrent.futures.ProcessPoolExecutor
+        The process pool, with its workers initialized by `init_parse_worker`.
+    workers : int
+        The number of worker processes.
+
+    Yields
+    ------
+    parsed_line : tuple
+        The next parsed line, as returned by `parse_line`.
+    """
+
+    lines = iter(lines)
+    pending = deque()
+
+    while True:
+        chunk = list(itertools.islice(lines, PARSE_CHUNK_SIZE))
+        if not chunk:
+            break
+
+        pending.append(executor.submit(parse_chunk, chunk))
+
+        # Only keep a few chunks in flight, to bound the memory in use.
+        if len(pending) >= 2 * workers:
+            yield from parsed_chunk_lines(pending.popleft())
+
+    while pending:
+        yield from parsed_chunk_lines(pending.popleft())
+
+
+def parsed_chunk_lines(future):
+    """
+    Get the parsed lines of a chunk parsed by `parse_chunk`, and add up the
+    lines found in the memo of its worker process or not.
+
+    Parameters
+    ----------
+    future : concurrent.futures.Future
+        The future of the parsed chunk.
+
+    Returns
+    -------
+    parsed_lines : list
+        The parsed lines of the chunk.
+    """
+
+    parsedlines, hits, misses = future.result()
+    parsememostats["hits"] += hits
+    parsememostats["misses"] += misses
+
+    return parsedlines
+
+
+def prune_parsed_lines(parsedlines, pruneparams, filtercounts):
+    """
+    Drop the unwanted lines of the parsed merged host files.
+
+    Comments and blank lines are passed through. Rules are dropped if they
+    are invalid, or match a post.json filter, an exclusion or the whitelist.
+    Duplicates are not removed here.
+
+    Parameters
+    ----------
+    parsedlines : iterable
+        The lines to prune, as parsed by `parse_line`.
+    pruneparams : dict
+        Dictionary providing the parameters for pruning the lines.
+        Currently, those fields are:
+
+        1) filterautomaton: the post.json filters, as compiled by
+           `compile_filters`, or None if there are no filters.
+        2) exclusions: as compiled by `compile_exclusions`.
+        3) whitelist: as compiled by `compile_whitelist`.
+    filtercounts : list
+        The number of lines removed by each post.json filter, indexed by
+        filter, which is updated in place.
+
+    Yields
+    ------
+    pruned_line : tuple
+        A tuple of the hostname and the normalized rule, or of None and the
+        line itself for comments and blank lines.
+    """
+
+    filterautomaton = pruneparams["filterautomaton"]
+    exclusions = pruneparams["exclusions"]
+    whitelist = pruneparams["whitelist"]
+
+    for line, strippedrule, hostname, data in parsedlines:
+        # Apply post.json filters
+        if filterautomaton:
+            matched_filter = match_filters(line, filterautomaton)
+            if matched_filter is not None:
+                filtercounts[matched_filter] += 1
+                continue
+
+        if strippedrule is None:
+            if data is not None:
+                yield None, data
+            continue
+
+        if matches_exclusions(strippedrule, exclusions):
+            continue
+
+        if matches_whitelist(line.replace("\t+", " ").rstrip(" ."), whitelist):
+            continue
+
+        if data:
+            yield hostname, data
+
+
+def remove_dups_and_excl(parsedlines, exclusionregexes, finalfile):
+    """
+    Remove duplicates and remove hosts that we are excluding.
+
+    We check for duplicate hostnames as well as remove any hostnames that
+    have been explicitly excluded by the user.
+
+    Parameters
+    ----------
+    parsedlines : iterable
+        The parsed lines of the merged host files that we are pruning, such
+        as the ones from `merge_parsed_lines`.
+    exclusionregexes : list
+        The list of regex patterns used to exclude domains.
+    finalfile : file
+        The file object in which the result is written.
+    """
+
+    numberofrules = settings["numberofrules"]
     maybe_copy_example_file(settings["whitelistfile"])
 
     if os.path.isfile(settings["whitelistfile"]):
@@ -943,10 +2367,13 @@ def remove_dups_and_excl(mergefile, exclusionregexes, finalfile):
     if not os.path.exists(settings["outputpath"]):
         os.makedirs(settings["outputpath"])
 
-    # analyze any post.json here
-    post_json_path = os.path.join(os.path.dirname(finalfile.name), "post.json")
+    # analyze any post.json here. Compressed and minimised hosts files were
+    # always deduplicated into a system temporary file, next to which no
+    # post.json was ever found, so they keep being left unfiltered.
+    post_json_path = os.path.join(settings["outputpath"], "post.json")
     filters = []
-    if os.path.isfile(post_json_path):
+    reduced = settings["compress"] or settings["minimise"]
+    if not reduced and os.path.isfile(post_json_path):
         try:
             with open(post_json_path, "r", encoding="UTF-8") as post_file:
                 post_data = json.load(post_file)
@@ -954,237 +2381,560 @@ def remove_dups_and_excl(mergefile, exclusionregexes, finalfile):
         except Exception as e:
             print_failure(f"Error reading post.json: {e}")
 
-    mergefile.seek(0)  # reset file pointer
-    hostnames = {"localhost", "localhost.localdomain", "local", "broadcasthost"}
-    exclusions = settings["exclusions"]
+    hostnames = set(RESERVED_HOSTNAMES)
+    if settings["dedup"] == "compact":
+        hostnames = CompactHostnameSet(hostnames)
 
-    for line in mergefile.readlines():
-        write_line = True
+    pruneparams = {
+        "filterautomaton": compile_filters(filters) if filters else None,
+        "exclusions": compile_exclusions(
+            exclusionregexes, settings["exclusionpattern"]
+        ),
+        "whitelist": compile_whitelist(settings["exclusions"]),
+    }
+    filtercounts = [0] * len(filters)
+
+    # A variant matrix shared between several builds deduplicates them all
+    # at once, as long as they are pruned the same way.
+    variantlines = None
+    if settings.get("variantmatrix") is not None:
+        passkey = (
+            tuple(filters),
+            tuple(settings["exclusions"]),
+            tuple(regex.pattern for regex in exclusionregexes),
+            settings["exclusionpattern"],
+            settings["targetip"],
+            settings["keepdomaincomments"],
+            settings["datapath"],
+            settings["extensionspath"],
+            settings["hostfilename"],
+            settings["blacklistfile"],
+        )
+        variantlines = settings["variantmatrix"].variant_lines(
+            pruneparams, passkey, filtercounts
+        )
 
-        # Explicit encoding
-        line = line.decode("UTF-8")
+    prunedlines = prune_parsed_lines(parsedlines, pruneparams, filtercounts)
+
+    profile = settings.get("profile")
+    if profile is not None:
+        prunedlines = profile.iterate(prunedlines, "prune")
+
+    def deduplicated():
+        nonlocal numberofrules
+
+        if variantlines is not None:
+            for hostname, data in variantlines:
+                if hostname is not None:
+                    numberofrules += 1
+                yield hostname, data
+            return
+
+        for hostname, data in prunedlines:
+            if hostname is None:
+                yield None, data
+            elif hostname not in hostnames:
+                hostnames.add(hostname)
+                numberofrules += 1
+                yield hostname, data
+
+    outputlines = deduplicated()
+
+    # When collapsing subdomains, the output is held back until all the
+    # hostnames are known.
+    if settings["collapsesubdomains"]:
+        heldlines = list(outputlines)
+        covered = covered_subdomains(
+            hostname for hostname, _ in heldlines if hostname is not None
+        )
 
-        # Apply post.json filters
-        if filters and any(f in line for f in filters):
-            continue
+        outputlines = (
+            (hostname, data) for hostname, data in heldlines if hostname not in covered
+        )
 
-        # replace tabs with space
-        line = line.replace("\t+", " ")
+        numberofrules -= len(covered)
+        print(
+            "Collapsed {:,} domains already covered by a parent domain".format(
+                len(covered)
+            )
+        )
 
-        # see gh-271: trim trailing whitespace, periods
-        line = line.rstrip(" .")
+    writer = BatchWriter(finalfile)
 
-        # Testing the first character doesn't require startswith
-        if line[0] == "#" or re.match(r"^\s*$", line[0]):
-            write_data(finalfile, line)
-            continue
-        if "::1" in line:
-            continue
+    # Compressing and minimising only reformat the rules, so they are done
+    # on the fly rather than on a copy of the output.
+    if settings["compress"] or settings["minimise"]:
+        if settings["compress"]:
+            packedlines = compress_lines(
+                (data for _, data in outputlines),
+                settings["targetip"],
+                settings["domainsperline"],
+            )
+        else:
+            packedlines = minimise_lines(
+                (data for _, data in outputlines), settings["targetip"]
+            )
 
-        strippedrule = strip_rule(line)  # strip comments
-        if not strippedrule or matches_exclusions(strippedrule, exclusionregexes):
-            continue
+        for line in packedlines:
+            writer.write(line, line.count(" "))
+    else:
+        for hostname, data in outputlines:
+            writer.write(data, hostname is not None)
 
-        # Issue #1628
-        if "@" in strippedrule:
-            continue
+    writer.flush()
+    settings["numberofrules"] = numberofrules
 
-        # Normalize rule
-        hostname, normalized_rule = normalize_rule(
-            strippedrule,
-            targetip=settings["targetip"],
-            keep_domain_comments=settings["keepdomaincomments"],
+    if profile is not None:
+        profile.count(
+            "deduplicate", rules=writer.ruleswritten, bytes=writer.byteswritten
         )
 
-        for exclude in exclusions:
-            if re.search(r"(^|[\s\.])" + re.escape(exclude) + r"\s", line):
-                write_line = False
+    # The hostnames seen so far are released from here on.
+    memory = settings.get("memory")
+    if memory is not None:
+        memory.checkpoint()
+
+    for post_filter, count in zip(filters, filtercounts):
+        if count:
+            print(
+                "The post.json filter '{}' removed {:,} lines".format(
+                    post_filter, count
+                )
+            )
+
+
+def covered_subdomains(hostnames):
+    """
+    Find the hostnames that are subdomains of another hostname.
+
+    The hostnames are stored in a trie of their labels, read from right to
+    left, so that each hostname is checked against its parent domains in a
+    single walk down the trie.
+
+    Parameters
+    ----------
+    hostnames : iterable
+        The unique hostnames to check.
+
+    Returns
+    -------
+    covered : set
+        The hostnames that have one of their parent domains among the
+        hostnames. For instance, "a.b.example.com" is covered by
+        "example.com".
+    """
+
+    hostnames = list(hostnames)
+
+    # Labels are never empty, so the empty string marks a hostname's node.
+    trie = {}
+    for hostname in hostnames:
+        node = trie
+        for label in reversed(hostname.split(".")):
+            node = node.setdefault(label, {})
+        node[""] = {}
+
+    covered = set()
+    for hostname in hostnames:
+        node = trie
+        for label in reversed(hostname.split(".")[1:]):
+            node = node[label]
+            if "" in node:
+                covered.add(hostname)
                 break
 
-        if normalized_rule and (hostname not in hostnames) and write_line:
-            write_data(finalfile, normalized_rule)
-            hostnames.add(hostname)
-            numberofrules += 1
+    return covered
 
-    settings["numberofrules"] = numberofrules
-    mergefile.close()
 
+class CompactHostnameSet(object):
+    """
+    A set of hostnames with a small memory footprint.
 
-# Dot-separated labels of [a-z0-9_-], hyphens not at label ends, at least two
-# labels. Expects a lowercased hostname.
-VALID_DOMAIN_REGEX = re.compile(
-    r"(?:[a-z0-9_]|[a-z0-9_][a-z0-9_-]*[a-z0-9_])"
-    r"(?:\.(?:[a-z0-9_]|[a-z0-9_][a-z0-9_-]*[a-z0-9_]))+"
-)
+    A Python set of strings costs around 100 bytes per hostname. Here, the
+    hostnames are encoded back to back into a single bytearray, and found
+    through an open-addressing table of their 64-bit hashes, which brings
+    the cost down to the encoded hostname plus about 30 bytes. Hostnames
+    with the same hash are told apart by comparing their encoded bytes.
+    """
+
+    def __init__(self, hostnames=()):
+        self.data = bytearray()
+        self.offsets = array("Q", [0])
+        self.hashes = array("Q")
+        self.slots = array("I", [0]) * 16
+
+        for hostname in hostnames:
+            self.add(hostname)
+
+    @staticmethod
+    def hash(hostname):
+        return hash(hostname) & 0xFFFFFFFFFFFFFFFF
+
+    def find(self, hostname, hostnamehash):
+        """
+        Find the slot of a hostname, or the free slot where it belongs.
+
+        Returns
+        -------
+        slot : tuple
+            A tuple of the index of the slot, and whether the hostname
+            was found there.
+        """
+
+        mask = len(self.slots) - 1
+        index = hostnamehash & mask
+        encoded = None
+
+        while True:
+            entry = self.slots[index]
+            if not entry:
+                return index, False
+
+            entry -= 1
+            if self.hashes[entry] == hostnamehash:
+                if encoded is None:
+                    encoded = hostname.encode("UTF-8")
+
+                start, end = self.offsets[entry], self.offsets[entry + 1]
+                if self.data[start:end] == encoded:
+                    return index, True
 
+            index = (index + 1) & mask
 
-def is_valid_domain(hostname):
+    def add(self, hostname):
+        hostnamehash = self.hash(hostname)
+        index, found = self.find(hostname, hostnamehash)
+        if found:
+            return
+
+        self.data += hostname.encode("UTF-8")
+        self.offsets.append(len(self.data))
+        self.hashes.append(hostnamehash)
+        self.slots[index] = len(self.hashes)
+
+        # Keep the table at most half full, so that probe runs stay short.
+        if 2 * len(self.hashes) > len(self.slots):
+            self.resize(2 * len(self.slots))
+
+    def resize(self, size):
+        slots = array("I", [0]) * size
+        mask = size - 1
+
+        for entry, hostnamehash in enumerate(self.hashes):
+            index = hostnamehash & mask
+            while slots[index]:
+                index = (index + 1) & mask
+            slots[index] = entry + 1
+
+        self.slots = slots
+
+    def __contains__(self, hostname):
+        return self.find(hostname, self.hash(hostname))[1]
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+# Four groups of one to three digits: every IPv4 address that ipaddress
+# accepts has this shape, as do a few strings that it rejects.
+IPV4_SHAPE_REGEX = re.compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
+
+
+@functools.lru_cache(maxsize=1024)
+def is_ip_address(token):
     """
-    Check whether a lowercased hostname looks like a valid domain name.
+    Check whether a token is an IP address.
+
+    Only tokens that have the shape of an IP address reach this check in
+    `normalize_rule`, and they are few, so the results are memoized.
 
     Parameters
     ----------
-    hostname : str
-        The hostname to validate.
+    token : str
+        The token to check.
 
     Returns
     -------
-    valid : bool
-        Whether the hostname only contains characters allowed in a domain
-        name and has a valid label structure.
+    is_ip : bool
+        Whether ipaddress understands the token as an IPv4 or IPv6 address.
     """
 
-    return bool(VALID_DOMAIN_REGEX.fullmatch(hostname))
+    try:
+        ipaddress.ip_address(token)
+        return True
+    except ValueError:
+        return False
 
 
-def normalize_rule(rule, targetip, keep_domain_comments):
+# Dot-separated labels of [a-z0-9_-], hyphens not at label ends, at least two
+# labels. Expects a lowercased hostname.
+VALID_DOMAIN_REGEX = re.compile(
+    r"(?:[a-z0-9_]|[a-z0-9_][a-z0-9_-]*[a-z0-9_])"
+    r"(?:\.(?:[a-z0-9_]|[a-z0-9_][a-z0-9_-]*[a-z0-9_]))+"
+)
+
+
+class VariantMatrix(object):
     """
-    Standardize and format the rule string provided.
+    Remove the duplicates of many variants of the hosts file at once.
+
+    A variant merges the base sources (unless nounifiedhosts is set), some
+    extensions and the blacklist, in that order, so its lines are a
+    subsequence of those of all these groups merged together. The merged
+    groups are pruned and deduplicated in a single pass, which records for
+    each hostname a bitmask of the groups it was seen in so far: a rule goes
+    into every variant that includes its group and none of those groups.
+    The variants that a rule goes into only depend on its group and that
+    bitmask, so they are computed once for each such pair.
+
+    The variants built with different pruning settings, such as a different
+    post.json, are deduplicated in separate passes.
 
     Parameters
     ----------
-    rule : str
-        The rule whose spelling and spacing we are standardizing.
-    targetip : str
-        The target IP address for the rule.
-    keep_domain_comments : bool
-        Whether or not to keep comments regarding these domains in
-        the normalized rule.
-
-    Returns
-    -------
-    normalized_rule : tuple
-        A tuple of the hostname and the rule string with spelling
-        and spacing reformatted.
+    variants : iterable
+        Tuples of the extensions and the nounifiedhosts setting of each
+        variant to build.
     """
 
-    def normalize_response(
-        extracted_hostname: str, extracted_suffix: Optional[str]
-    ) -> Tuple[str, str]:
+    def __init__(self, variants):
+        self.variants = [
+            (tuple(sorted(extensions)), nounifiedhosts)
+            for extensions, nounifiedhosts in variants
+        ]
+        self.extensions = sorted(
+            set(
+                extension for extensions, _ in self.variants for extension in extensions
+            )
+        )
+
+        # The groups are the base sources, the extensions and the blacklist.
+        self.groups = [""] + self.extensions + [None]
+        self.variantgroups = []
+        for extensions, nounifiedhosts in self.variants:
+            groups = 1 << (len(self.groups) - 1)
+            if not nounifiedhosts:
+                groups |= 1
+            for extension in extensions:
+                groups |= 1 << self.groups.index(extension)
+            self.variantgroups.append(groups)
+
+        self.passes = {}
+
+    def deduplicate(self, pruneparams, filtercount):
         """
-        Normalizes the responses after the provision of the extracted
-        hostname and suffix - if exist.
+        Prune and deduplicate the merged groups for all the variants.
 
         Parameters
         ----------
-        extracted_hostname: str
-            The extracted hostname to work with.
-        extracted_suffix: str
-            The extracted suffix to with.
+        pruneparams : dict
+            The parameters of `prune_parsed_lines`.
+        filtercount : int
+            The number of post.json filters.
 
         Returns
         -------
-        normalized_response: tuple
-            A tuple of the hostname and the rule string with spelling
-            and spacing reformatted.
+        deduplicated : tuple
+            A tuple of the list of the pruned lines, as yielded by
+            `prune_parsed_lines`, the list of the bitmasks of the variants
+            that each of them goes into, the number of lines removed by
+            each post.json filter in each group, and the invalid rules of
+            each group, as `RejectedRules`. None if the variants can't be
+            told apart, which happens when a group but the last one doesn't
+            end with a newline.
         """
 
-        rule = "%s %s" % (targetip, extracted_hostname)
+        initial_files = list_initial_files(
+            nounifiedhosts=False, extensions=self.extensions
+        )
 
-        if keep_domain_comments and extracted_suffix:
-            if not extracted_suffix.strip().startswith("#"):
-                # Strings are stripped, therefore we need to add the space back.
-                rule += " # %s" % extracted_suffix
-            else:
-                rule += " %s" % extracted_suffix
+        groupvariants = [
+            sum(
+                1 << variant
+                for variant, groups in enumerate(self.variantgroups)
+                if groups >> group & 1
+            )
+            for group in range(len(self.groups))
+        ]
+        allgroups = (1 << len(self.groups)) - 1
+
+        seen = dict.fromkeys(RESERVED_HOSTNAMES, allgroups)
+        targets = {}
+
+        prunedlines = []
+        linevariants = []
+        filtercounts = []
+        grouprejects = []
+
+        # The invalid rules of each group are collected apart, for the
+        # variants that include the group. The rules themselves are only kept
+        # if the rejects of the settings keep them.
+        rejects = settings.get("rejects")
+        keeprules = rejects is not None and rejects.rules is not None
+
+        for group, name in enumerate(self.groups):
+            groupfiles = [
+                initial_file
+                for initial_file in initial_files
+                if initial_file[3] == name
+            ]
+
+            grouprejects.append(RejectedRules(keeprules=keeprules))
+            settings["rejects"] = grouprejects[group]
+            try:
+                parsedlines = list(join_parsed_lines(parse_initial_files(groupfiles)))
+            finally:
+                settings["rejects"] = rejects
+
+            if (
+                parsedlines
+                and not parsedlines[-1][0].endswith("\n")
+                and group < len(self.groups) - 1
+            ):
+                return None
+
+            groupbit = 1 << group
+            filtercounts.append([0] * filtercount)
+
+            for hostname, data in prune_parsed_lines(
+                parsedlines, pruneparams, filtercounts[group]
+            ):
+                if hostname is None:
+                    variants = groupvariants[group]
+                else:
+                    hostnamegroups = seen.get(hostname, 0)
+
+                    variants = targets.get((group, hostnamegroups))
+                    if variants is None:
+                        variants = sum(
+                            1 << variant
+                            for variant, groups in enumerate(self.variantgroups)
+                            if groups & groupbit and not groups & hostnamegroups
+                        )
+                        targets[(group, hostnamegroups)] = variants
 
-        return extracted_hostname, rule + "\n"
+                    seen[hostname] = hostnamegroups | groupbit
 
-    def is_ip(dataset: str) -> bool:
+                if variants:
+                    prunedlines.append((hostname, data))
+                    linevariants.append(variants)
+
+        return prunedlines, linevariants, filtercounts, grouprejects
+
+    def variant_lines(self, pruneparams, passkey, filtercounts):
         """
-        Checks whether the given dataset is an IP.
+        Get the deduplicated lines of the variant that we are building.
+
+        The variant is the one of the extensions and nounifiedhosts of the
+        settings. The invalid rules of its groups are collected in the
+        rejects of the settings, if any.
 
         Parameters
         ----------
-
-        dataset: str
-            The dataset to work with.
+        pruneparams : dict
+            The parameters of `prune_parsed_lines`.
+        passkey : tuple
+            The settings that the pruning depends on. Variants with the same
+            key share a pass.
+        filtercounts : list
+            The number of lines removed by each post.json filter, which is
+            updated in place.
 
         Returns
         -------
-        is_ip: bool
-            Whether the dataset is an IP.
+        variant_lines : iterable
+            The lines of the variant, as yielded by `prune_parsed_lines`
+            without the duplicates, or None if the variant can't be built
+            by the matrix.
         """
 
         try:
-            _ = ipaddress.ip_address(dataset)
-            return True
+            variant = self.variants.index(
+                (tuple(settings["extensions"]), settings["nounifiedhosts"])
+            )
         except ValueError:
-            return False
+            return None
 
-    def belch_unwanted(unwanted: str) -> Tuple[None, None]:
-        """
-        Belches unwanted to screen.
+        if passkey not in self.passes:
+            self.passes[passkey] = self.deduplicate(pruneparams, len(filtercounts))
 
-        Parameters
-        ----------
-        unwanted: str
-            The unwanted string to belch.
+        deduplicated = self.passes[passkey]
+        if deduplicated is None:
+            return None
 
-        Returns
-        -------
-        belched: tuple
-            A tuple of None, None.
-        """
+        prunedlines, linevariants, groupfiltercounts, grouprejects = deduplicated
 
-        """
-        finally, if we get here, just belch to screen
-        """
-        print("==>%s<==" % unwanted)
-        return None, None
+        rejects = settings.get("rejects")
 
-    """
-    first try: IP followed by domain
-    """
+        groups = self.variantgroups[variant]
+        for group, counts in enumerate(groupfiltercounts):
+            if groups >> group & 1:
+                for index, count in enumerate(counts):
+                    filtercounts[index] += count
+                if rejects is not None:
+                    rejects.update(grouprejects[group])
 
-    static_ip_regex = r"^(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})$"
-    split_rule = rule.split(maxsplit=1)
+        return (
+            prunedline
+            for prunedline, variants in zip(prunedlines, linevariants)
+            if variants >> variant & 1
+        )
 
-    if is_ip(split_rule[0]):
-        # Assume that the first item is an IP address following the rule.
 
-        if " " or "\t" in split_rule[-1]:
-            try:
-                # Example: 0.0.0.0 example.org # hello, world!
-                hostname, suffix = split_rule[-1].split(maxsplit=1)
-            except ValueError:
-                # Example: 0.0.0.0 example.org[:space:]
-                hostname, suffix = split_rule[-1], None
-        else:
-            # Example: 0.0.0.0 example.org
-            hostname, suffix = split_rule[-1], None
+def normalize_rule(rule, targetip, keep_domain_comments):
+    """
+    Standardize and format the rule string provided.
 
-        hostname = hostname.lower()
+    The rule is split once, and its first token is only handed to ipaddress
+    when it has the shape of an IP address.
 
-        if (
-            is_ip(hostname)
-            or re.search(static_ip_regex, hostname)
-            or not is_valid_domain(hostname)
-        ):
-            # Example: 0.0.0.0 127.0.0.1
+    Parameters
+    ----------
+    rule : str
+        The rule whose spelling and spacing we are standardizing.
+    targetip : str
+        The target IP address for the rule.
+    keep_domain_comments : bool
+        Whether or not to keep comments regarding these domains in
+        the normalized rule.
 
-            # If the hostname is an IP (or looks like one), or isn't a valid
-            # domain (bad characters, no dot, repeated/trailing dots, slash,
-            # colon, ...), we don't want to normalize it.
-            return belch_unwanted(rule)
+    Returns
+    -------
+    normalized_rule : tuple
+        A tuple of the hostname and the rule string with spelling
+        and spacing reformatted.
+    """
 
-        return normalize_response(hostname, suffix)
+    split_rule = rule.split(maxsplit=1)
+    token = split_rule[0]
 
-    if not re.search(static_ip_regex, split_rule[0]) and is_valid_domain(
-        split_rule[0].lower()
-    ):
-        # Deny anything that looks like an IP; doesn't container dots or INVALID.
+    if (":" in token or IPV4_SHAPE_REGEX.fullmatch(token)) and is_ip_address(token):
+        # Example: 0.0.0.0 example.org # hello, world!
+        split_rule = split_rule[-1].split(maxsplit=1)
+        token = split_rule[0]
 
-        try:
-            hostname, suffix = split_rule
-        except ValueError:
-            hostname, suffix = split_rule[0], None
+    # Example: example.org # hello, world!
+    hostname = token.lower()
+
+    # If the hostname is an IP (or looks like one), or isn't a valid domain
+    # (bad characters, no dot, repeated/trailing dots, slash, colon, ...),
+    # we don't want to normalize it.
+    if IPV4_SHAPE_REGEX.fullmatch(hostname) or not VALID_DOMAIN_REGEX.fullmatch(
+        hostname
+    ):
+        return None, None
 
-        hostname = hostname.lower()
+    normalized_rule = targetip + " " + hostname
 
-        return normalize_response(hostname, suffix)
+    if keep_domain_comments and len(split_rule) > 1:
+        suffix = split_rule[1]
+        if not suffix.strip().startswith("#"):
+            # Strings are stripped, therefore we need to add the space back.
+            normalized_rule += " # " + suffix
+        else:
+            normalized_rule += " " + suffix
 
-    return belch_unwanted(rule)
+    return hostname, normalized_rule + "\n"
 
 
 def strip_rule(line):
@@ -1205,9 +2955,37 @@ def strip_rule(line):
     return " ".join(line.split())
 
 
+def build_time():
+    """
+    Get the time at which the files are built.
+
+    It is the time given by the SOURCE_DATE_EPOCH environment variable if
+    set, so that builds can be reproduced, or the current time otherwise.
+    A SOURCE_DATE_EPOCH that isn't a valid timestamp is reported and the
+    current time is used instead.
+
+    Returns
+    -------
+    buildtime : time.struct_time
+        The build time, in UTC.
+    """
+
+    sourcedateepoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if sourcedateepoch:
+        try:
+            return time.gmtime(int(sourcedateepoch))
+        except (ValueError, OverflowError, OSError):
+            print_failure(
+                f"Invalid SOURCE_DATE_EPOCH {sourcedateepoch!r}, using the current time."
+            )
+
+    return time.gmtime()
+
+
 def write_opening_header(finalfile, **headerparams):
     """
-    Write the header information into the newly-created hosts file.
+    Write the header information into the newly-created hosts file, ahead
+    of the hosts themselves.
 
     Parameters
     ----------
@@ -1224,135 +3002,114 @@ def write_opening_header(finalfile, **headerparams):
         5) nounifiedhosts
     """
 
-    finalfile.seek(0)  # Reset file pointer.
-    file_contents = finalfile.read()  # Save content.
-
-    finalfile.seek(0)  # Write at the top.
+    writer = BatchWriter(finalfile)
 
     nounifiedhosts = headerparams["nounifiedhosts"]
 
     if headerparams["extensions"]:
         if nounifiedhosts:
             if len(headerparams["extensions"]) > 1:
-                write_data(
-                    finalfile,
+                writer.write(
                     "# Title: StevenBlack/hosts extensions {0} and {1} \n#\n".format(
                         ", ".join(headerparams["extensions"][:-1]),
                         headerparams["extensions"][-1],
                     ),
                 )
             else:
-                write_data(
-                    finalfile,
+                writer.write(
                     "# Title: StevenBlack/hosts extension {0}\n#\n".format(
                         ", ".join(headerparams["extensions"])
                     ),
                 )
         else:
             if len(headerparams["extensions"]) > 1:
-                write_data(
-                    finalfile,
+                writer.write(
                     "# Title: StevenBlack/hosts with the {0} and {1} extensions\n#\n".format(
                         ", ".join(headerparams["extensions"][:-1]),
                         headerparams["extensions"][-1],
                     ),
                 )
             else:
-                write_data(
-                    finalfile,
+                writer.write(
                     "# Title: StevenBlack/hosts with the {0} extension\n#\n".format(
                         ", ".join(headerparams["extensions"])
                     ),
                 )
     else:
-        write_data(finalfile, "# Title: StevenBlack/hosts\n#\n")
+        writer.write("# Title: StevenBlack/hosts\n#\n")
 
-    write_data(
-        finalfile,
+    writer.write(
         "# This hosts file is a merged collection "
         "of hosts from reputable sources,\n",
     )
-    write_data(finalfile, "# with a dash of crowd sourcing via GitHub\n#\n")
-    write_data(
-        finalfile,
-        "# Date: " + time.strftime("%d %B %Y %H:%M:%S (%Z)", time.gmtime()) + "\n",
+    writer.write("# with a dash of crowd sourcing via GitHub\n#\n")
+    writer.write(
+        "# Date: " + time.strftime("%d %B %Y %H:%M:%S (%Z)", build_time()) + "\n",
     )
 
     if headerparams["extensions"]:
         if headerparams["nounifiedhosts"]:
-            write_data(
-                finalfile,
+            writer.write(
                 "# The unified hosts file was not used while generating this file.\n"
                 "# Extensions used to generate this file: "
                 + ", ".join(headerparams["extensions"])
                 + "\n",
             )
         else:
-            write_data(
-                finalfile,
+            writer.write(
                 "# Extensions added to this file: "
                 + ", ".join(headerparams["extensions"])
                 + "\n",
             )
 
-    write_data(
-        finalfile,
-        (
-            "# Number of unique domains: {:,}\n#\n".format(
-                headerparams["numberofrules"]
-            )
-        ),
+    writer.write(
+        "# Number of unique domains: {:,}\n#\n".format(headerparams["numberofrules"]),
     )
-    write_data(
-        finalfile,
+    writer.write(
         "# Fetch the latest version of this file: "
         "https://raw.githubusercontent.com/StevenBlack/hosts/master/"
         + path_join_robust(headerparams["outputsubfolder"], "").replace("\\", "/")
         + "hosts\n",
     )
-    write_data(
-        finalfile, "# Project home page: https://github.com/StevenBlack/hosts\n"
-    )
-    write_data(
-        finalfile,
+    writer.write("# Project home page: https://github.com/StevenBlack/hosts\n")
+    writer.write(
         "# Project releases: https://github.com/StevenBlack/hosts/releases\n#\n",
     )
-    write_data(
-        finalfile,
+    writer.write(
         "# ===============================================================\n",
     )
-    write_data(finalfile, "\n")
+    writer.write("\n")
 
     if not headerparams["skipstatichosts"]:
-        write_data(finalfile, "127.0.0.1 localhost\n")
-        write_data(finalfile, "127.0.0.1 localhost.localdomain\n")
-        write_data(finalfile, "127.0.0.1 local\n")
-        write_data(finalfile, "255.255.255.255 broadcasthost\n")
-        write_data(finalfile, "::1 localhost\n")
-        write_data(finalfile, "::1 ip6-localhost\n")
-        write_data(finalfile, "::1 ip6-loopback\n")
-        write_data(finalfile, "fe80::1%lo0 localhost\n")
-        write_data(finalfile, "ff00::0 ip6-localnet\n")
-        write_data(finalfile, "ff00::0 ip6-mcastprefix\n")
-        write_data(finalfile, "ff02::1 ip6-allnodes\n")
-        write_data(finalfile, "ff02::2 ip6-allrouters\n")
-        write_data(finalfile, "ff02::3 ip6-allhosts\n")
-        write_data(finalfile, "0.0.0.0 0.0.0.0\n")
+        writer.write("127.0.0.1 localhost\n")
+        writer.write("127.0.0.1 localhost.localdomain\n")
+        writer.write("127.0.0.1 local\n")
+        writer.write("255.255.255.255 broadcasthost\n")
+        writer.write("::1 localhost\n")
+        writer.write("::1 ip6-localhost\n")
+        writer.write("::1 ip6-loopback\n")
+        writer.write("fe80::1%lo0 localhost\n")
+        writer.write("ff00::0 ip6-localnet\n")
+        writer.write("ff00::0 ip6-mcastprefix\n")
+        writer.write("ff02::1 ip6-allnodes\n")
+        writer.write("ff02::2 ip6-allrouters\n")
+        writer.write("ff02::3 ip6-allhosts\n")
+        writer.write("0.0.0.0 0.0.0.0\n")
 
         if platform.system() == "Linux":
-            write_data(finalfile, "127.0.1.1 " + socket.gethostname() + "\n")
-            write_data(finalfile, "127.0.0.53 " + socket.gethostname() + "\n")
+            writer.write("127.0.1.1 " + socket.gethostname() + "\n")
+            writer.write("127.0.0.53 " + socket.gethostname() + "\n")
 
-        write_data(finalfile, "\n")
+        writer.write("\n")
 
     preamble = path_join_robust(BASEDIR_PATH, "myhosts")
     maybe_copy_example_file(preamble)
 
     if os.path.isfile(preamble):
         with open(preamble, "r") as f:
-            write_data(finalfile, f.read())
+            writer.write(f.read())
 
-    finalfile.write(file_contents)
+    writer.flush()
 
 
 def update_readme_data(readme_file, **readme_updates):
@@ -1374,26 +3131,47 @@ def update_readme_data(readme_file, **readme_updates):
         5) nounifiedhosts
     """
 
-    extensions_key = "base"
-    extensions = readme_updates["extensions"]
-    nounifiedhosts = readme_updates["nounifiedhosts"]
+    merge_readme_data(readme_file, [readme_updates])
+
+
+def merge_readme_data(readme_file, readme_updates_list):
+    """
+    Update the README JSON data with the information of several hosts files
+    at once, reading and writing the file only once.
+
+    Parameters
+    ----------
+    readme_file : str
+        The name of the README file to update.
+    readme_updates_list : list
+        The fields to update for each hosts file, as the readme_updates of
+        `update_readme_data`.
+    """
+
+    readme_entries = {}
+    for readme_updates in readme_updates_list:
+        extensions_key = "base"
+        extensions = readme_updates["extensions"]
+        nounifiedhosts = readme_updates["nounifiedhosts"]
 
-    if extensions:
-        extensions_key = "-".join(extensions)
-        if nounifiedhosts:
-            extensions_key = extensions_key + "-only"
-
-    output_folder = readme_updates["outputsubfolder"]
-    generation_data = {
-        "location": path_join_robust(output_folder, ""),
-        "nounifiedhosts": nounifiedhosts,
-        "entries": readme_updates["numberofrules"],
-        "sourcesdata": readme_updates["sourcesdata"],
-    }
+        if extensions:
+            extensions_key = "-".join(extensions)
+            if nounifiedhosts:
+                extensions_key = extensions_key + "-only"
+
+        output_folder = readme_updates["outputsubfolder"]
+        generation_data = {
+            "location": path_join_robust(output_folder, ""),
+            "nounifiedhosts": nounifiedhosts,
+            "entries": readme_updates["numberofrules"],
+            "sourcesdata": readme_updates["sourcesdata"],
+        }
+
+        readme_entries[extensions_key] = generation_data
 
     with open(readme_file, "r") as f:
         readme_data = json.load(f)
-        readme_data[extensions_key] = generation_data
+        readme_data.update(readme_entries)
 
     for denomination, data in readme_data.copy().items():
         if "location" in data and data["location"] and "\\" in data["location"]:
@@ -1417,11 +3195,11 @@ def move_hosts_file_into_place(finalfile):
 
     Parameters
     ----------
-    finalfile : file object
-        The newly-created hosts file to move.
+    finalfile : file object or str
+        The newly-created hosts file to move, or its path.
     """  # noqa: W605
 
-    filename = os.path.abspath(finalfile.name)
+    filename = os.path.abspath(getattr(finalfile, "name", finalfile))
 
     try:
         if not Path(filename).exists():
@@ -1559,38 +3337,200 @@ def flush_dns_cache():
             print_failure("Unable to determine DNS management tool.")
 
 
-def remove_old_hosts_file(path_to_file, file_name, backup):
+def replace_hosts_file(newfile_path, hostsfile_path, backup):
     """
-    Remove the old hosts file.
+    Put a newly built hosts file in place of the old one.
 
-    This is a hotfix because merging with an already existing hosts file leads
-    to artifacts and duplicates.
+    The old hosts file is replaced at once, so that it is never seen missing
+    or partly written.
 
     Parameters
     ----------
+    newfile_path : str
+        The path of the newly built hosts file, which must be on the same
+        file system as the old one.
+    hostsfile_path : str
+        The path of the hosts file to replace.
     backup : boolean, default False
         Whether or not to backup the existing hosts file.
     """
 
-    fullfilepath = path_join_robust(path_to_file, file_name)
+    if backup and os.path.exists(hostsfile_path):
+        backupfilepath = hostsfile_path + "-{}".format(
+            time.strftime("%Y-%m-%d-%H-%M-%S")
+        )
+
+        # Make a backup copy, marking the date in which the list was updated
+        shutil.copy(hostsfile_path, backupfilepath)
+
+    # Temporary files are only readable by their owner, unlike hosts files.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(newfile_path, 0o666 & ~umask)
+
+    os.replace(newfile_path, hostsfile_path)
+
+
+def file_digest(path):
+    """
+    Compute the SHA-256 digest of a file.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+
+    Returns
+    -------
+    digest : str
+        The hexadecimal digest of the file, or None if it does not exist.
+    """
+
+    if not os.path.isfile(path):
+        return None
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(WRITE_BATCH_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hosts_file_digest(*files):
+    """
+    Compute the SHA-256 digest of the contents of a hosts file, but for the
+    date in its header.
+
+    Parameters
+    ----------
+    files : varargs
+        The binary file objects that, read in turn, make up the hosts file.
+
+    Returns
+    -------
+    digest : str
+        The hexadecimal digest of the hosts file.
+    """
+
+    digest = hashlib.sha256()
+    datefound = False
+
+    for f in files:
+        for line in f:
+            if not datefound and line.startswith(b"# Date: "):
+                datefound = True
+                continue
+            digest.update(line)
+
+    return digest.hexdigest()
+
+
+def build_key(exclusionregexes, sourcesdata):
+    """
+    Compute the build key of the hosts file described by the settings.
+
+    The key covers everything the hosts file is built from: this script,
+    the host files merged into it, the whitelist, myhosts and post.json
+    files, the information about its sources and the settings in
+    BUILD_KEY_SETTINGS. Two builds with the same key give the same hosts
+    file, but for its date.
+
+    Parameters
+    ----------
+    exclusionregexes : list
+        The exclusion regexes of the hosts file.
+    sourcesdata : list
+        The information about the sources of the hosts file, as returned
+        by `update_sources_data`.
+
+    Returns
+    -------
+    buildkey : str
+        The build key of the hosts file.
+    """
+
+    preamble = path_join_robust(BASEDIR_PATH, "myhosts")
+    maybe_copy_example_file(settings["whitelistfile"])
+    maybe_copy_example_file(preamble)
+
+    inputfiles = [os.path.realpath(__file__)]
+    inputfiles.extend(
+        initial_file[0]
+        for initial_file in list_initial_files(
+            nounifiedhosts=settings["nounifiedhosts"]
+        )
+    )
+    inputfiles.extend(
+        [
+            settings["whitelistfile"],
+            preamble,
+            path_join_robust(settings["outputpath"], "post.json"),
+        ]
+    )
+
+    buildsettings = {name: settings.get(name) for name in BUILD_KEY_SETTINGS}
+    buildsettings["exclusionregexes"] = [
+        getattr(regex, "pattern", regex) for regex in exclusionregexes
+    ]
+    buildsettings["sourcesdata"] = sourcesdata
+    if not settings["skipstatichosts"] and platform.system() == "Linux":
+        buildsettings["hostname"] = socket.gethostname()
+
+    digest = hashlib.sha256(
+        json.dumps(buildsettings, sort_keys=True).encode("UTF-8") + b"\0"
+    )
+    for path in inputfiles:
+        # Relative paths keep the key the same for any clone of the repo.
+        digest.update(os.path.relpath(path, BASEDIR_PATH).encode("UTF-8") + b"\0")
+        digest.update((file_digest(path) or "").encode("UTF-8") + b"\0")
+
+    return digest.hexdigest()
 
-    if os.path.exists(fullfilepath):
-        if backup:
-            backupfilepath = fullfilepath + "-{}".format(
-                time.strftime("%Y-%m-%d-%H-%M-%S")
-            )
 
-            # Make a backup copy, marking the date in which the list was updated
-            shutil.copy(fullfilepath, backupfilepath)
+def read_build_record(cachefile_path):
+    """
+    Read the record of the last build of a hosts file.
+
+    Parameters
+    ----------
+    cachefile_path : str
+        The path of the sidecar file in which the record is stored.
+
+    Returns
+    -------
+    record : dict
+        The "key", "numberofrules" and "sha256" of the last build, or an
+        empty dictionary if none is recorded.
+    """
 
-        os.remove(fullfilepath)
+    if not os.path.isfile(cachefile_path):
+        return {}
 
-    # Create directory if not exists
-    if not os.path.exists(path_to_file):
-        os.makedirs(path_to_file)
+    try:
+        with open(cachefile_path, "r", encoding="UTF-8") as cachefile:
+            record = json.load(cachefile)
+    except ValueError:
+        # A damaged sidecar simply means a full build.
+        return {}
+
+    return record if isinstance(record, dict) else {}
+
+
+def write_build_record(cachefile_path, record):
+    """
+    Record the last build of a hosts file.
+
+    Parameters
+    ----------
+    cachefile_path : str
+        The path of the sidecar file in which the record is stored.
+    record : dict
+        The record to store.
+    """
 
-    # Create new empty hosts file
-    open(fullfilepath, "a").close()
+    with open(cachefile_path, "w", encoding="UTF-8") as cachefile:
+        json.dump(record, cachefile, indent=2, sort_keys=True)
 
 
 # End File Logic
@@ -1725,11 +3665,101 @@ def get_file_by_url(url, params=None, **kwargs):
         print("Error retrieving data from {}".format(url))
         return None
 
+    return decode_hosts_response(req)
+
+
+def decode_hosts_response(req, profile=None):
+    """
+    Decode the hosts file in a response, then pass it through domain_to_idna().
+
+    Parameters
+    ----------
+    req : requests.Response
+        The response to the request for the hosts file.
+    profile : Profile, default None
+        The profile in which to record the domain_to_idna() pass, if any.
+
+    Returns
+    -------
+    res_text : str
+        The hosts file, with its domains in IDNA form.
+    """
+
     req.encoding = req.apparent_encoding
-    res_text = "\n".join([domain_to_idna(line) for line in req.text.split("\n")])
+    lines = req.text.split("\n")
+
+    with profile.stage("idna") if profile else contextlib.nullcontext():
+        res_text = "\n".join([domain_to_idna(line) for line in lines])
+    if profile:
+        profile.count("idna", lines=len(lines))
+
     return res_text
 
 
+def get_source_by_url(url, validators, profile=None):
+    """
+    Retrieve the contents of the hosts file at the URL, unless it hasn't
+    changed since the download described by `validators`.
+
+    The ETag and Last-Modified validators are sent as a conditional request,
+    so that an unchanged file isn't downloaded again. Servers that ignore
+    conditional requests are caught by comparing the content hash instead,
+    which still saves the domain_to_idna() pass and the file rewrite.
+
+    Parameters
+    ----------
+    url : str or bytes
+        URL for the new Request object.
+    validators : dict
+        The "etag", "lastmodified" and "sha256" validators of the last
+        download, as returned by a previous call. May be empty.
+    profile : Profile, default None
+        The profile in which to record the domain_to_idna() pass, if any.
+
+    Returns
+    -------
+    url_data : str or None
+        The data retrieved at that URL, passed through domain_to_idna().
+        Returns None if the data hasn't changed since the last download.
+    validators : dict
+        The validators describing the data at that URL.
+
+    Raises
+    ------
+    requests.exceptions.RequestException : The retrieval was unsuccessful,
+        including when the server answered with an error status.
+    """
+
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("lastmodified"):
+        headers["If-Modified-Since"] = validators["lastmodified"]
+
+    req = requests.get(url=url, headers=headers)
+
+    if req.status_code == 304:
+        return None, validators
+
+    # An error page must neither replace the hosts file nor be recorded as
+    # its validators.
+    if not 200 <= req.status_code < 300:
+        raise requests.exceptions.HTTPError(
+            "{} answered with status {}".format(url, req.status_code), response=req
+        )
+
+    new_validators = {
+        "etag": req.headers.get("ETag"),
+        "lastmodified": req.headers.get("Last-Modified"),
+        "sha256": hashlib.sha256(req.content).hexdigest(),
+    }
+
+    if new_validators["sha256"] == validators.get("sha256"):
+        return None, new_validators
+
+    return decode_hosts_response(req, profile), new_validators
+
+
 def write_data(f, data):
     """
     Write data to a file object.
@@ -1745,6 +3775,416 @@ def write_data(f, data):
     f.write(bytes(data, "UTF-8"))
 
 
+class Profile(object):
+    """
+    Record where a build spends its time, stage by stage and source by
+    source, along with the amounts of data that go through each stage.
+
+    The stages of a build are streamed into each other, so the time of a
+    stage is only the time spent in it, not in the stages nested in it.
+    Stages run in threads add up their times.
+
+    Parameters
+    ----------
+    memory : MemoryTracker, default None
+        The memory tracker of the build, if any, whose report is included.
+    """
+
+    def __init__(self, memory=None):
+        self.memory = memory
+        self.stages = {}
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = (time.perf_counter(), time.process_time())
+
+    def push(self):
+        stack = self.local.__dict__.setdefault("stack", [])
+        frame = [time.perf_counter(), time.process_time(), 0.0, 0.0]
+        stack.append(frame)
+        return frame
+
+    def pop(self, frame):
+        wall = time.perf_counter() - frame[0]
+        cpu = time.process_time() - frame[1]
+
+        stack = self.local.stack
+        stack.pop()
+        if stack:
+            stack[-1][2] += wall
+            stack[-1][3] += cpu
+
+        return wall - frame[2], cpu - frame[3]
+
+    @contextlib.contextmanager
+    def stage(self, stage, source=None):
+        """
+        Record the time spent in a stage, within a with statement.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        source : str, default None
+            The source that the stage works on, if any.
+        """
+
+        frame = self.push()
+        try:
+            yield
+        finally:
+            wall, cpu = self.pop(frame)
+            self.count(stage, source, wall=wall, cpu=cpu)
+
+    def iterate(self, iterable, stage, source=None):
+        """
+        Record the time spent in a stage that produces lines, as they are
+        consumed, and how many lines it produces.
+
+        The lines are produced and timed a chunk at a time, so that timing
+        them costs little next to producing them, and the counters are only
+        updated once all of them are consumed.
+
+        Parameters
+        ----------
+        iterable : iterable
+            The lines produced by the stage.
+        stage : str
+            The name of the stage.
+        source : str, default None
+            The source that the stage works on, if any.
+
+        Yields
+        ------
+        line : object
+            The next line produced by the stage.
+        """
+
+        iterator = iter(iterable)
+        lines = 0
+        wall = cpu = 0.0
+
+        try:
+            while True:
+                frame = self.push()
+                try:
+                    chunk = list(itertools.islice(iterator, PROFILE_CHUNK_SIZE))
+                finally:
+                    chunkwall, chunkcpu = self.pop(frame)
+                    wall += chunkwall
+                    cpu += chunkcpu
+
+                if not chunk:
+                    return
+
+                lines += len(chunk)
+                yield from chunk
+        finally:
+            self.count(stage, source, wall=wall, cpu=cpu, lines=lines)
+
+    def count(self, stage, source=None, **counts):
+        """
+        Add to the counters of a stage, such as its lines or bytes.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        source : str, default None
+            The source that the stage works on, if any.
+        counts : kwargs
+            The amounts to add to the counters of the same names.
+        """
+
+        with self.lock:
+            entries = [self.stages.setdefault(stage, {})]
+            if source is not None:
+                entries.append(self.sources.setdefault(source, {}).setdefault(stage, {}))
+
+            for entry in entries:
+                for name, amount in counts.items():
+                    entry[name] = entry.get(name, 0) + amount
+
+    def report(self):
+        """
+        Report what was recorded.
+
+        Returns
+        -------
+        report : dict
+            The total wall and CPU times of the build, and the times and
+            counters of each stage, overall and by source. CPU times are those
+            of this process, without the worker processes of --workers.
+        """
+
+        report = {
+            "wall": time.perf_counter() - self.start[0],
+            "cpu": time.process_time() - self.start[1],
+            "stages": self.stages,
+            "sources": self.sources,
+        }
+        if parsememostats["hits"] or parsememostats["misses"]:
+            report["parsememo"] = dict(parsememostats)
+        if self.memory is not None:
+            report["memory"] = self.memory.report()
+
+        return report
+
+    def write(self, path):
+        """
+        Write the report of what was recorded as JSON.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file to write.
+        """
+
+        with open(path, "w", encoding="UTF-8") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+def max_rss():
+    """
+    Get the highest resident set size of this process so far.
+
+    Returns
+    -------
+    rss : int
+        The highest resident set size, in bytes, or None where it is not
+        available.
+    """
+
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux and the BSDs count in kilobytes, macOS in bytes.
+    return rss if platform.system() == "Darwin" else rss * 1024
+
+
+class MemoryTracker(object):
+    """
+    Record the memory high-water mark of each stage of a build, to find the
+    stage that needs the most memory.
+
+    For each stage, this records the peak of the memory allocated by Python
+    during the stage, as traced by `tracemalloc`, and the highest RSS of the
+    process at the end of the stage. It also records the allocation sites
+    holding the most memory at the checkpoint of the stage where the most
+    memory was allocated, the end of the stage being one. The worker
+    processes of --workers are not included.
+
+    Parameters
+    ----------
+    topsites : int, default 5
+        The number of allocation sites to record for each stage.
+    """
+
+    def __init__(self, topsites=5):
+        self.topsites = topsites
+        self.stages = {}
+        self.frames = []
+        self.started = not tracemalloc.is_tracing()
+
+        if self.started:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Record the memory high-water mark of a stage, within a with statement.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        """
+
+        # The peak is reset for the stage, so the peak reached so far by the
+        # enclosing stage is kept aside.
+        start, peak = tracemalloc.get_traced_memory()
+        if self.frames:
+            self.frames[-1]["peak"] = max(self.frames[-1]["peak"], peak)
+
+        frame = dict(peak=start, checkpoint=-1, sites=[])
+        self.frames.append(frame)
+        tracemalloc.reset_peak()
+
+        try:
+            yield
+        finally:
+            self.checkpoint()
+
+            end, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, frame["peak"])
+
+            self.frames.pop()
+            if self.frames:
+                outer = self.frames[-1]
+                outer["peak"] = max(outer["peak"], peak)
+                if frame["checkpoint"] > outer["checkpoint"]:
+                    outer["checkpoint"] = frame["checkpoint"]
+                    outer["sites"] = frame["sites"]
+
+            self.stages[stage] = dict(
+                start=start,
+                end=end,
+                peak=peak,
+                rss=max_rss(),
+                tracing=tracemalloc.get_tracemalloc_memory(),
+                sites=frame["sites"],
+            )
+
+    def checkpoint(self):
+        """
+        Record the top allocation sites of the current stage, if more memory
+        is allocated now than at its previous checkpoints.
+
+        A stage checkpoints where its memory is likely to peak, such as just
+        before releasing what it built up.
+        """
+
+        if not self.frames:
+            return
+
+        frame = self.frames[-1]
+        current = tracemalloc.get_traced_memory()[0]
+        if current <= frame["checkpoint"]:
+            return
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        frame["checkpoint"] = current
+        frame["sites"] = [
+            dict(
+                site="{}:{}".format(
+                    os.path.basename(statistic.traceback[0].filename),
+                    statistic.traceback[0].lineno,
+                ),
+                size=statistic.size,
+                count=statistic.count,
+            )
+            for statistic in snapshot.statistics("lineno")[: self.topsites]
+        ]
+
+    def report(self):
+        """
+        Report what was recorded.
+
+        Returns
+        -------
+        report : dict
+            The memory allocated at the start and end of each stage, its peak,
+            the RSS high-water mark and the memory used by the tracing itself,
+            which is part of that RSS, in bytes, and the top allocation sites
+            at the checkpoint of the stage with the most memory.
+        """
+
+        return self.stages
+
+    def summary(self):
+        """
+        Summarize the memory high-water mark of each stage.
+
+        Returns
+        -------
+        summary : str
+            The peak memory and RSS of each stage, with its top allocation
+            sites.
+        """
+
+        def mib(size):
+            return "n/a" if size is None else "{:,.1f} MiB".format(size / 1048576)
+
+        lines = ["Memory high-water mark by stage:\n"]
+        for stage, entry in self.stages.items():
+            lines.append(
+                "  {}: {} allocated, {} RSS ({} of it tracing)\n".format(
+                    stage, mib(entry["peak"]), mib(entry["rss"]), mib(entry["tracing"])
+                )
+            )
+            lines.extend(
+                "    {}: {}\n".format(site["site"], mib(site["size"]))
+                for site in entry["sites"]
+            )
+
+        return "".join(lines)
+
+    def close(self):
+        """
+        Stop tracing memory allocations, if started by this tracker.
+        """
+
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+
+class BatchWriter(object):
+    """
+    Collect data written to a file object and write it out in large batches.
+
+    Writing every rule on its own costs a system call per line, which adds
+    up on slow (e.g. network-mounted) output volumes. The data is collected
+    as text and encoded a batch at a time rather than line by line.
+
+    Parameters
+    ----------
+    f : file
+        The binary file object at which to write the data.
+    flushsize : int
+        The number of characters to collect before writing them to the file.
+    """
+
+    def __init__(self, f, flushsize=WRITE_BATCH_SIZE):
+        self.f = f
+        self.flushsize = flushsize
+        self.pending = []
+        self.pendingsize = 0
+        self.byteswritten = 0
+        self.ruleswritten = 0
+
+    def write(self, data, rules=0):
+        """
+        Write data to the file object, once enough of it has been collected.
+
+        Parameters
+        ----------
+        data : str
+            The data to write to the file.
+        rules : int
+            The number of rules in the data, for bookkeeping.
+        """
+
+        self.pending.append(data)
+        self.pendingsize += len(data)
+        self.ruleswritten += rules
+
+        if self.pendingsize >= self.flushsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all the collected data to the file object.
+        """
+
+        if self.pending:
+            data = "".join(self.pending).encode("UTF-8")
+            self.f.write(data)
+            self.byteswritten += len(data)
+            self.pending = []
+            self.pendingsize = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
 def list_dir_no_hidden(path):
     """
     List all files in a directory, except for hidden files.
@@ -10,6 +10,8 @@ import os
 import time
 from string import Template
 
+from updateHostsFile import build_time
+
 # Project Settings
 BASEDIR_PATH = os.path.dirname(os.path.realpath(__file__))
 README_TEMPLATE = os.path.join(BASEDIR_PATH, "readme_template.md")
@@ -17,6 +19,20 @@ README_FILENAME = "readme.md"
 README_DATA_FILENAME = "readmeData.json"
 
 
+def write_if_changed(path, contents):
+    """
+    Write the contents to the file, unless it already holds them.
+    """
+
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8", newline="\n") as f:
+            if f.read() == contents:
+                return
+
+    with open(path, "wt", encoding="utf-8", newline="\n") as out:
+        out.write(contents)
+
+
 def main():
     s = Template(
         "${description} | [Readme](https://github.com/StevenBlack/"
@@ -85,17 +101,11 @@ def main():
             this_row.update(source)
             source_rows += t.substitute(this_row) + "\n"
 
-        with open(
-            os.path.join(data[key]["location"], README_FILENAME),
-            "wt",
-            encoding="utf-8",
-            newline="\n",
-        ) as out, open(
-            README_TEMPLATE, encoding="utf-8", newline="\n"
-        ) as template:
+        lines = []
+        with open(README_TEMPLATE, encoding="utf-8", newline="\n") as template:
             for line in template:
                 line = line.replace(
-                    "@GEN_DATE@", time.strftime("%B %d %Y", time.gmtime())
+                    "@GEN_DATE@", time.strftime("%B %d %Y", build_time())
                 )
                 line = line.replace("@EXTENSIONS@", extensions_str)
                 line = line.replace("@EXTENSIONS_HEADER@", extensions_header)
@@ -116,7 +126,11 @@ def main():
                     line = line.replace(
                         "@SIZEHISTORY@", "![Size history](stats.png)")
 
-                out.write(line)
+                lines.append(line)
+
+        write_if_changed(
+            os.path.join(data[key]["location"], README_FILENAME), "".join(lines)
+        )
 
 
 if __name__ == "__main__":